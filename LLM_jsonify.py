@@ -1,8 +1,11 @@
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, LogitsProcessorList, StoppingCriteriaList
 import json
 import re
 
+from utils.grammar_utils import STRUCTURED_MESSAGE_GRAMMAR
+from utils.llm_backends.llama import GrammarLogitsProcessor, GrammarStoppingCriteria
+
 # --- 設定 ---
 MODEL_ID = "meta-llama/Meta-Llama-3.1-8B-Instruct"
 CACHE_DIR = "models/"
@@ -67,6 +70,7 @@ Use the following JSON schema:
     "intent": "One of [PROPOSE, INFORM, REQUEST, AGREE, REJECT]",
     "target_object": "The name of the object you are interested in (e.g., 'red key') or null",
     "target_coordinate": [x, y] coordinates as a list of integers, or null",
+    "action_plan": "Brief description of your planned action",
     "message": "A short natural language message to your partner"
 }
 """
@@ -115,6 +119,25 @@ Use the following JSON schema:
             print(json.dumps(parsed_json, indent=2))
         else:
             print("❌ JSON Parse Failed")
+
+        # スキーマを強制した生成と比較する
+        prompt_len = len(inputs.input_ids[0])
+        with torch.no_grad():
+            constrained_outputs = model.generate(
+                **inputs,
+                max_new_tokens=256,
+                do_sample=False,
+                temperature=None,
+                top_p=None,
+                logits_processor=LogitsProcessorList([GrammarLogitsProcessor(STRUCTURED_MESSAGE_GRAMMAR, tokenizer, prompt_len, [tokenizer.eos_token_id])]),
+                stopping_criteria=StoppingCriteriaList([GrammarStoppingCriteria(STRUCTURED_MESSAGE_GRAMMAR, tokenizer, prompt_len)]),
+                return_dict_in_generate=True,
+                pad_token_id=tokenizer.eos_token_id
+            )
+        constrained_ids = constrained_outputs.sequences[0][prompt_len:]
+        constrained_text = tokenizer.decode(constrained_ids, skip_special_tokens=True)
+        print(f"Constrained Output:\n{constrained_text}\n")
+        print(f"Tokens: unconstrained {len(generated_ids)}, constrained {len(constrained_ids)}, saved {len(generated_ids) - len(constrained_ids)}")
         
         print("\n")
 
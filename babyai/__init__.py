@@ -1,10 +1,18 @@
 # Import levels so that the OpenAI Gym environments get registered
 # when the babyai package is imported
 from . import levels
-from . import utils
+import importlib
 import warnings
 
 
+# babyai.utils imports torch, so it is only imported when it is first accessed
+# (environments can then be registered without torch, e.g. for free/random runs)
+def __getattr__(name):
+    if name == "utils":
+        return importlib.import_module(".utils", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 warnings.warn(
     "This code base is no longer maintained and is not expected to be maintained again. \n"
     "These environments are now maintained within Minigrid"
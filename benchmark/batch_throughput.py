@@ -0,0 +1,59 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import gc
+import time
+import argparse
+from utils.llm_utils import LLM
+from utils.registry_utils import ModelRegistry
+
+# ローカルのバックエンド(Flan, Llama)について, バッチサイズごとのまとめて生成する速度(prompts/s, tokens/s)を比較する
+# 貪欲法で生成し, 最初の1バッチは慣らし運転として計測から除く
+
+PROMPTS = [
+    "You are agent{i} in a grid world. There is a red ball in front of you. What is the best action? Answer in one sentence.",
+    "You are agent{i}. Your teammate is holding the key and the door is locked. What should you do next?",
+    "Summarize the mission 'pick up the blue box' for agent{i} in one short sentence.",
+    "Agent{i} sees a wall to the left and an open door ahead. Choose one action from: left, right, forward, pickup.",
+]
+
+def make_prompts(count:int) -> list[str]:
+    return [PROMPTS[i % len(PROMPTS)].format(i=i) for i in range(count)]
+
+def measure(llm:LLM, prompts:list[str], batch_size:int) -> dict:
+    llm.batch_size = batch_size
+    llm._generate_text_batch(prompts[:batch_size], [None] * batch_size)
+    start = time.perf_counter()
+    outputs = llm._generate_text_batch(prompts, [None] * len(prompts))
+    elapsed = time.perf_counter() - start
+    tokens = sum(llm._count_tokens(text) for text, _ in outputs)
+    return {"prompts_per_sec": len(prompts) / elapsed, "tokens_per_sec": tokens / elapsed, "text": outputs[0][0]}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", nargs="+", default=["google/flan-t5-base", "meta-llama/Llama-3.2-1B-Instruct"])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--prompts", type=int, default=32)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    prompts = make_prompts(args.prompts)
+    params = {} if args.threads is None else {"llm_cpu_threads": args.threads}
+    profile = {"max_new_tokens": args.max_new_tokens, "temperature": 0}
+    print(f"prompts: {len(prompts)}, max_new_tokens: {args.max_new_tokens}")
+    print(f"{'model':<40} {'batch':>5} {'prompts/s':>10} {'tokens/s':>9}")
+    for model_name in args.models:
+        llm = LLM.create(model_name, params)
+        with llm.use_profile(profile):
+            for batch_size in args.batch_sizes:
+                result = measure(llm, prompts, batch_size)
+                print(f"{model_name:<40} {batch_size:>5} {result['prompts_per_sec']:>10.2f} {result['tokens_per_sec']:>9.1f}")
+            print(f"    {result['text'][:80]!r}")
+        del llm
+        ModelRegistry.clear()
+        gc.collect()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import json
+import argparse
+import subprocess
+
+# CPU上でのLlamaの推論について, bfloat16とint8動的量子化の速度(tokens/s)とピークメモリ(RSS)を比較する
+# 読み込み時のメモリを正しく計測するため, 設定ごとに別プロセスで実行する
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+PROMPT = "You are an agent in a grid world. There is a red ball in front of you. What is the best action? Explain briefly."
+
+# 子プロセスで実行する計測処理
+MEASURE_CODE = """
+import sys, json, time, resource
+model_name, quantization, max_new_tokens, threads, prompt = sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), sys.argv[5]
+from utils.llm_utils import LLM
+params = {"llm_cpu_quantization": quantization, "llm_cpu_threads": threads}
+start = time.perf_counter()
+llm = LLM.get_backend_class(model_name)(model_name, params)
+load_time = time.perf_counter() - start
+profile = {"max_new_tokens": max_new_tokens, "temperature": 0}
+with llm.use_profile(profile):
+    llm._generate_text(prompt)
+    start = time.perf_counter()
+    text, _ = llm._generate_text(prompt)
+    generate_time = time.perf_counter() - start
+tokens = len(llm.tokenizer(text, add_special_tokens=False)["input_ids"])
+print(json.dumps({
+    "load": load_time,
+    "tokens": tokens,
+    "tokens_per_sec": tokens / generate_time,
+    "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "text": text,
+}))
+"""
+
+def measure(model_name:str, quantization:str, max_new_tokens:int, threads:int) -> dict:
+    result = subprocess.run([sys.executable, "-c", MEASURE_CODE, model_name, quantization, str(max_new_tokens), str(threads), PROMPT],
+                            cwd=ROOT, capture_output=True, text=True, env={**os.environ, "CUDA_VISIBLE_DEVICES": ""})
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="meta-llama/Meta-Llama-3.1-8B-Instruct")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    print(f"model: {args.model}, max_new_tokens: {args.max_new_tokens}, threads: {args.threads}")
+    print(f"{'quantization':<14} {'load(s)':>8} {'tokens/s':>9} {'peak RSS(MB)':>13}")
+    for quantization in ["none", "int8"]:
+        result = measure(args.model, quantization, args.max_new_tokens, args.threads)
+        if "error" in result:
+            print(f"{quantization:<14} error: {result['error']}")
+            continue
+        print(f"{quantization:<14} {result['load']:>8.1f} {result['tokens_per_sec']:>9.2f} {result['peak_rss_mb']:>13.0f}")
+        print(f"    {result['text'][:80]!r}")
+
+if __name__ == "__main__":
+    main()
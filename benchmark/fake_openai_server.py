@@ -0,0 +1,67 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import json
+import time
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# OpenAI互換のChat Completions APIを模したローカルサーバ
+# 一定の遅延と429エラーを返すことで, APIを使わずに並行実行やレート制限の動作を確認する
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    latency = 0.5 # 1リクエストあたりの応答時間(s)
+    error_rate = 0.0 # 429エラーを返す確率
+    request_count = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length))
+        with self.lock:
+            FakeOpenAIHandler.request_count += 1
+
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}})
+            return
+
+        prompt = " ".join(str(message["content"]) for message in body["messages"])
+        text = "go to the forward coordinate"
+        prompt_tokens = len(prompt.split())
+        completion_tokens = len(text.split())
+        self.send_json(200, {
+            "id": f"chatcmpl-{self.request_count}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    def send_json(self, status:int, content:dict):
+        data = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+# バックグラウンドでサーバを起動し, base_urlを返す
+def start(port:int=0, latency:float=0.5, error_rate:float=0.0) -> tuple[ThreadingHTTPServer, str]:
+    FakeOpenAIHandler.latency = latency
+    FakeOpenAIHandler.error_rate = error_rate
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeOpenAIHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+if __name__ == "__main__":
+    server, base_url = start(8001)
+    print(f"fake OpenAI server is running on {base_url}")
+    server.serve_forever()
@@ -0,0 +1,65 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import glob
+import json
+import subprocess
+from utils.llm_utils import LLM
+
+# config/baseの各モデル設定について, main.pyの起動(import)にかかる時間を計測する
+# 各計測はキャッシュの影響を避けるため別プロセスで行う
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+HEAVY_MODULES = ["torch", "transformers", "openai", "tiktoken", "sentence_transformers", "bitsandbytes"]
+
+# 子プロセスで実行する計測処理
+MEASURE_CODE = """
+import sys, json, time
+start = time.perf_counter()
+import main
+from utils.llm_utils import LLM
+main_time = time.perf_counter() - start
+LLM.get_backend_class(sys.argv[1])
+backend_time = time.perf_counter() - start - main_time
+print(json.dumps({
+    "main": main_time,
+    "backend": backend_time,
+    "modules": [name for name in sys.argv[2:] if name in sys.modules],
+}))
+"""
+
+# config/baseからモデル名を集める(モデルを使わない場合は"free")
+def get_model_profiles() -> dict[str, str]:
+    profiles = {"free": "free"}
+    for path in sorted(glob.glob(os.path.join(ROOT, "config", "base", "*.json"))):
+        with open(path) as f:
+            config = json.load(f)
+        model_name = config.get("hyperparam", {}).get("llm_model")
+        if model_name is not None:
+            profiles[os.path.splitext(os.path.basename(path))[0]] = model_name
+    return profiles
+
+def measure(model_name:str) -> dict:
+    result = subprocess.run([sys.executable, "-c", MEASURE_CODE, model_name] + HEAVY_MODULES,
+                            cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main(repeat:int=3):
+    print(f"{'profile':<20} {'backend':<14} {'main(s)':>8} {'backend(s)':>10}  imported")
+    for profile, model_name in get_model_profiles().items():
+        backend_name = LLM.get_backend_name(model_name)
+        results = [measure(model_name) for _ in range(repeat)]
+        errors = [r["error"] for r in results if "error" in r]
+        if len(errors) > 0:
+            print(f"{profile:<20} {backend_name:<14} error: {errors[0]}")
+            continue
+        main_time = min(r["main"] for r in results)
+        backend_time = min(r["backend"] for r in results)
+        modules = ",".join(results[-1]["modules"])
+        print(f"{profile:<20} {backend_name:<14} {main_time:>8.2f} {backend_time:>10.2f}  {modules}")
+
+if __name__ == "__main__":
+    main()
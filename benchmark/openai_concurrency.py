@@ -0,0 +1,37 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import time
+import benchmark.fake_openai_server as fake_openai_server
+from utils.llm_backends.gpt import Gpt
+
+# 偽のOpenAIサーバに対して, 逐次実行と並行実行の所要時間を比較する
+
+def main(request_count:int=8, latency:float=0.5, error_rate:float=0.2):
+    server, base_url = fake_openai_server.start(latency=latency, error_rate=error_rate)
+    params = {
+        "openai_base_url": base_url,
+        "openai_requests_per_minute": 600,
+        "openai_tokens_per_minute": 100000,
+        "openai_retry_wait": 0.1,
+    }
+    llm = Gpt("gpt-4o", params)
+    prompts = [f"You are agent{i}. What is the best action?" for i in range(request_count)]
+
+    start = time.perf_counter()
+    for prompt in prompts:
+        llm._generate_text(prompt)
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    llm._generate_text_batch(prompts, [None] * len(prompts))
+    concurrent = time.perf_counter() - start
+
+    print(f"requests: {request_count}, latency: {latency}s, error rate: {error_rate}")
+    print(f"sequential: {sequential:.2f}s, concurrent: {concurrent:.2f}s")
+    print(f"input token: {llm.input_token}, output token: {llm.output_token}")
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import json
+import glob
+import time
+import argparse
+from utils.llm_backends.llama import Llama
+
+# 実験で記録されたプロンプトを使い, 下書きモデルを使う生成(speculative decoding)の受理率と速度向上を測る
+# 貪欲法で生成するので, 下書きモデルの有無で出力は一致するはずである
+
+DEFAULT_PROMPTS = [
+    "You are agent0 in a grid world. There is a red ball in front of you. Choose one action from: left, right, forward, pickup.",
+    "You are agent1. Your teammate is holding the key. Think about what you should do next in one sentence.",
+]
+
+# 実行結果のログ(log_trial*.json)から各ステップのプロンプトを集める
+def load_prompts(log_dir:str, max_count:int) -> list[str]:
+    prompts = []
+    for path in sorted(glob.glob(os.path.join(log_dir, "**", "log_trial*.json"), recursive=True)):
+        with open(path) as f:
+            log = json.load(f)
+        for entry in log:
+            for step in entry.get("steps", []):
+                prompts.extend(step["info"].get("queries", []))
+        if len(prompts) >= max_count: break
+    if len(prompts) == 0:
+        prompts = DEFAULT_PROMPTS
+    return prompts[:max_count]
+
+# 順伝播の回数を数える
+class CallCounter:
+    def __init__(self, model):
+        self.count = 0
+        model.register_forward_hook(self.hook)
+
+    def hook(self, module, inputs, output):
+        self.count += 1
+
+def run(llm:Llama, prompts:list[str], target:CallCounter, draft:CallCounter) -> dict:
+    result = {"time": 0.0, "tokens": 0, "target_calls": 0, "draft_calls": 0, "texts": []}
+    for prompt in prompts:
+        target.count, draft.count = 0, 0
+        start = time.perf_counter()
+        text, _ = llm._generate_text_batch([prompt], [None])[0]
+        result["time"] += time.perf_counter() - start
+        result["tokens"] += len(llm.tokenizer(text, add_special_tokens=False)["input_ids"])
+        result["target_calls"] += target.count
+        result["draft_calls"] += draft.count
+        result["texts"].append(text)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="meta-llama/Meta-Llama-3.1-8B-Instruct")
+    parser.add_argument("--draft", default="meta-llama/Llama-3.2-1B-Instruct")
+    parser.add_argument("--logs", default="./result", help="プロンプトを集める実行結果のフォルダ")
+    parser.add_argument("--max-prompts", type=int, default=20)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--num-assistant-tokens", type=int, default=5)
+    args = parser.parse_args()
+
+    prompts = load_prompts(args.logs, args.max_prompts)
+    llm = Llama(args.model, {})
+    draft_model = llm._load_model(args.draft, {})
+    draft_model.generation_config.num_assistant_tokens = args.num_assistant_tokens
+    target = CallCounter(llm.model)
+    draft = CallCounter(draft_model)
+
+    with llm.use_profile({"max_new_tokens": args.max_new_tokens, "temperature": 0}):
+        llm._generate_text_batch(prompts[:1], [None])
+        baseline = run(llm, prompts, target, draft)
+        llm.draft_model = draft_model
+        llm._generate_text_batch(prompts[:1], [None])
+        assisted = run(llm, prompts, target, draft)
+
+    # 本体の1回の検証で, 受理された下書きトークンに加えて1トークンが確定する
+    accepted = assisted["tokens"] - assisted["target_calls"]
+    acceptance_rate = accepted / max(assisted["draft_calls"], 1)
+    matched = sum(a == b for a, b in zip(baseline["texts"], assisted["texts"]))
+
+    print(f"prompts: {len(prompts)}, max_new_tokens: {args.max_new_tokens}, num_assistant_tokens: {args.num_assistant_tokens}")
+    print(f"baseline: {baseline['tokens'] / baseline['time']:.2f} tokens/s ({baseline['time']:.1f}s)")
+    print(f"assisted: {assisted['tokens'] / assisted['time']:.2f} tokens/s ({assisted['time']:.1f}s)")
+    print(f"speedup: {baseline['time'] / assisted['time']:.2f}x")
+    print(f"acceptance rate: {acceptance_rate:.2%} ({accepted}/{assisted['draft_calls']} draft tokens)")
+    print(f"tokens per target forward: {assisted['tokens'] / max(assisted['target_calls'], 1):.2f}")
+    print(f"identical outputs: {matched}/{len(prompts)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import json
+import glob
+import time
+import pstats
+import argparse
+import cProfile
+import tempfile
+
+from main import load_config, run
+from logger.logger import Logger
+from utils.llm_utils import LLM
+
+# LLMをスタブ(utils/llm_backends/stub.py)に置き換えてmain.runを最後まで実行し, 1秒あたりのステップ数を測る
+# --profileを付けると, LLM以外の処理(描画, ログ出力, 履歴の文字列化など)のどこに時間がかかっているかを表示する
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="Debug", help="実行するconfig名(モデル以外の設定はそのまま使う)")
+    parser.add_argument("--trials", type=int, default=1)
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0, help="スタブの1回の呼び出しあたりの待ち時間(s)")
+    parser.add_argument("--profile", action="store_true")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    config = {
+        **config,
+        "llm_model": "stub",
+        "llm_high_model": "none",
+        "free_mode": False,
+        "trial_count": args.trials,
+        "max_step": args.steps,
+        "realtime_rendering": False,
+        "stub_latency": args.latency,
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        logger = Logger(directory, "_stub")
+        LLM.load(config)
+
+        profiler = cProfile.Profile() if args.profile else None
+        start = time.perf_counter()
+        if profiler is not None: profiler.enable()
+        run(logger, None, 0, config)
+        if profiler is not None: profiler.disable()
+        elapsed = time.perf_counter() - start
+
+        steps = 0
+        for path in glob.glob(f"{logger.path}log_trial*.json"):
+            if "history" in os.path.basename(path): continue
+            with open(path) as f:
+                steps += len(json.load(f)[0]["steps"])
+
+    calls = sum(summary["calls"] for summary in LLM.get_usage().summarize().values())
+    print(f"config: {args.config}, trials: {args.trials}, latency: {args.latency}s")
+    print(f"steps: {steps}, elapsed: {elapsed:.2f}s, {steps / elapsed:.1f} steps/s")
+    print(f"LLM calls in last trial: {calls}")
+    if profiler is not None:
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(30)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import sys
+import os
+# カスタマイズしたライブラリは作業フォルダから優先的に参照する
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+import json
+import time
+import queue
+import base64
+import argparse
+import threading
+from io import BytesIO
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+from PIL import Image
+
+from main import load_config
+from utils.llm_utils import LLM
+
+# ローカルで常駐するOpenAI互換の推論サーバ
+# モデルを1度だけ読み込み, 複数の実験プロセスからのリクエストをまとめてバッチ推論する
+# 実験側はconfigの"llm_model"を"server:モデル名"にすると, このサーバを使う
+#
+# 起動例: python llm_server.py --config Debug --port 8000
+
+# 推論待ちのリクエスト
+class Request:
+    def __init__(self, prompt:str, image, profile:dict):
+        self.prompt = prompt
+        self.image = image
+        self.profile = profile
+        self.future = Future()
+
+    # 同じ生成設定のリクエストだけを同じバッチにまとめる
+    def get_profile_key(self) -> str:
+        return json.dumps(self.profile, sort_keys=True)
+
+# キューに溜まったリクエストをまとめてモデルに渡すワーカ
+class BatchWorker:
+    def __init__(self, llm:LLM, max_batch_size:int, batch_wait:float):
+        self.llm = llm
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self.requests: queue.Queue[Request] = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, request:Request) -> Future:
+        self.requests.put(request)
+        return request.future
+
+    # 最初のリクエストが来てから少しだけ待ち, その間に来たリクエストも同じバッチに載せる
+    def collect(self) -> list[Request]:
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0: break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            groups: dict[str, list[Request]] = {}
+            for request in batch:
+                groups.setdefault(request.get_profile_key(), []).append(request)
+            for requests in groups.values():
+                self.process(requests)
+
+    def process(self, requests:list[Request]):
+        profile = requests[0].profile
+        try:
+            with self.llm.use_profile(profile):
+                outputs = self.llm._generate_text_batch([r.prompt for r in requests], [r.image for r in requests])
+            for request, (text, _) in zip(requests, outputs):
+                request.future.set_result(LLM._truncate_at_stop(text, profile))
+        except Exception as e:
+            for request in requests:
+                request.future.set_exception(e)
+
+# OpenAI形式のメッセージからプロンプトと画像を取り出す
+def parse_messages(messages:list[dict]) -> tuple[str, np.ndarray]:
+    texts = []
+    image = None
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        for part in content:
+            if part["type"] == "text":
+                texts.append(part["text"])
+            elif part["type"] == "image_url":
+                data = part["image_url"]["url"].split(",", 1)[1]
+                image = np.array(Image.open(BytesIO(base64.b64decode(data))).convert("RGB"))
+    return "\n".join(texts), image
+
+# OpenAI形式の生成パラメータを生成設定に変換する
+def parse_profile(body:dict) -> dict:
+    profile = {}
+    max_tokens = body.get("max_completion_tokens", body.get("max_tokens"))
+    if max_tokens is not None:
+        profile["max_new_tokens"] = max_tokens
+    for key in ["temperature", "top_p"]:
+        if key in body:
+            profile[key] = body[key]
+    if body.get("stop") is not None:
+        stop = body["stop"]
+        profile["stop"] = [stop] if isinstance(stop, str) else stop
+    return profile
+
+def make_handler(llm:LLM, worker:BatchWorker, served_model_name:str):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/models"):
+                self.send_json(200, {"object": "list", "data": [{"id": served_model_name, "object": "model", "owned_by": "local"}]})
+            else:
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                return
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            prompt, image = parse_messages(body["messages"])
+            future = worker.submit(Request(prompt, image, parse_profile(body)))
+            try:
+                text = future.result()
+            except Exception as e:
+                self.send_json(500, {"error": {"message": str(e), "type": type(e).__name__}})
+                return
+
+            prompt_tokens = llm._count_tokens(prompt)
+            completion_tokens = llm._count_tokens(text)
+            self.send_json(200, {
+                "id": f"chatcmpl-{time.time_ns()}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": served_model_name,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+            })
+
+        def send_json(self, status:int, content:dict):
+            data = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default=None, help="モデル名と設定を読み込むconfig名(.jsonは省略)")
+    parser.add_argument("--model", default=None, help="読み込むモデル名(--configより優先)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--batch-wait", type=float, default=0.05, help="バッチを組むために待つ時間(s)")
+    args = parser.parse_args()
+
+    params = load_config(args.config) if args.config is not None else {}
+    model_name = args.model if args.model is not None else params["llm_model"]
+    if model_name.startswith("server:"):
+        model_name = model_name[len("server:"):]
+    params["llm_batch_size"] = args.max_batch_size
+
+    print(f"[info] loading {model_name} ...")
+    llm = LLM.create(model_name, params)
+    worker = BatchWorker(llm, args.max_batch_size, args.batch_wait)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(llm, worker, model_name))
+    print(f"[info] serving {model_name} on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -36,9 +36,12 @@ class MovieMaker:
         self.add_text_to_image(image, 3, 3, "white", f"t={step}")
 
     # 現時点で保持している画像からGifアニメーションを生成する
-    def make(self, name:str = "tmp"):
+    # 別スレッドで生成する場合は, その時点の画像のリストの複製をrgb_dataとして渡す
+    def make(self, name:str = "tmp", rgb_data:list = None):
+        if rgb_data is None:
+            rgb_data = self.rgb_data
         images = []
-        for i, rgb in enumerate(self.rgb_data):
+        for i, rgb in enumerate(rgb_data):
             rgb = np.array(rgb)
             image = Image.fromarray(rgb.astype('uint8')).convert('RGB')
             self.add_step_to_image(image, i)
@@ -46,8 +49,10 @@ class MovieMaker:
         images[0].save(f'{self.path}{name}.gif', save_all=True, append_images=images[1:],optimize=False, duration=100, loop=1)
     
     # 最終フレームだけ出力する(実行中もリアルタイムに状況を見たい場合)
-    def make_last_frame(self, name:str = "tmp"):
-        rgb = np.array(self.rgb_data[-1])
+    def make_last_frame(self, name:str = "tmp", rgb_data:list = None):
+        if rgb_data is None:
+            rgb_data = self.rgb_data
+        rgb = np.array(rgb_data[-1])
         image = Image.fromarray(rgb.astype('uint8')).convert('RGB')
-        self.add_step_to_image(image, len(self.rgb_data)-1)
+        self.add_step_to_image(image, len(rgb_data)-1)
         image.save(f'{self.path}{name}.png')
\ No newline at end of file
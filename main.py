@@ -21,6 +21,7 @@ from utils.reflexion_utils import Reflexion
 import utils.utils as utils
 from utils.subgoal_visualizer import main as subgoal_visualize
 from utils.embedding_utils import Embedder
+from utils.worker_utils import BackgroundWorker
 
 # ファイル名から設定を読み込む
 def load_config(config_name:str):
@@ -37,13 +38,18 @@ def load_config(config_name:str):
     params["config_name"] = config_name
     return params
 
+# 結果を出力するフォルダを作成し, 設定を書き出す
+def make_logger(config:dict) -> Logger:
+    logger = Logger("./result/" + config["env_name"] + "/" + config["policy_name"], "_" + config["config_name"])
+    logger.output("config", config)
+    return logger
+
 # 初期化と実行
 def init_and_run(config_name:str):
     config = load_config(config_name)
 
     # ログの設定
-    logger = Logger("./result/" + config["env_name"] + "/" + config["policy_name"], "_" + config["config_name"])
-    logger.output("config", config)
+    logger = make_logger(config)
 
     # LLMを読み込み
     LLM.load(config)
@@ -56,10 +62,25 @@ def init_and_run(config_name:str):
 # Reflexionを指定Trial分実行する
 def run(logger:Logger, reflexion:Reflexion, trial_start:int, config:dict):
 
-    def make_history_log(env):
-        history = [str(reflexion.histories[i]).split('\n') for i in range(env.agent_num)]
-        history.append("length: " + str(step+1))
-        return history
+    # 履歴の文字列化は出力と一緒に別スレッドで行うので, 履歴の複製を渡す
+    def output_history_log(name:str, histories:list, length:int):
+        history = [str(h).split('\n') for h in histories]
+        history.append("length: " + str(length))
+        logger.output(name, history)
+
+    def submit_history_log(trial:int):
+        histories = [reflexion.histories[i].snapshot() for i in range(env.agent_num)]
+        name = f"log_history_trial{trial}"
+        worker.submit(output_history_log, name, histories, step+1, key=name)
+
+    # 描画結果とログの出力は"is_use_background_worker"がTrueなら別スレッドで行う(LLMの応答待ちと重ねる)
+    def submit_movie(trial:int):
+        name = f"capture_trial{trial}"
+        worker.submit(movie_maker.make, name, list(movie_maker.rgb_data), key=name)
+
+    def submit_log(trial:int):
+        name = f"log_trial{trial}"
+        worker.submit(logger.output, name, list(logger.log), key=name)
     
     def initialize_subgoal(trial:int, log_init:dict):
         is_init_subgoal = utils.get_value(config, "is_use_init_subgoal", False)
@@ -78,10 +99,11 @@ def run(logger:Logger, reflexion:Reflexion, trial_start:int, config:dict):
             log_init["subgoals"] = info
 
     def finalize_subgoal(env, is_success, log_final):
-        policy_utils.judge_subgoal_achievement(env, reflexion, log_final, is_success, config)
+        policy_utils.judge_subgoal_achievement(env, reflexion, log_final, is_success, config, is_final=True)
 
     # 乱数に関する初期化
     seed = utils.get_value(config, "env_fixed_seed", None)
+    worker = BackgroundWorker(utils.get_value(config, "is_use_background_worker", False))
 
     # 指定された回数分エピソードを実行する
     for trial in tqdm(range(trial_start, config["trial_count"])):
@@ -101,15 +123,18 @@ def run(logger:Logger, reflexion:Reflexion, trial_start:int, config:dict):
         is_success = False
         reason = ""
 
+        usage = LLM.get_usage()
+        usage.clear()
+        usage.set_context(trial)
         initialize_subgoal(trial, log_init)
 
         # 指定ステップ繰り返す
         for step in tqdm(range(config["max_step"])):
             # 環境の描画
             movie_maker.render()
-            movie_maker.make(f"capture_trial{trial}")
+            submit_movie(trial)
             if config["realtime_rendering"] :
-                movie_maker.make_last_frame(f"capture_realtime")
+                worker.submit(movie_maker.make_last_frame, "capture_realtime", list(movie_maker.rgb_data), key="capture_realtime")
 
             # 現在の状態を履歴に追加
             obs_texts = env_utils.obs_to_str(env, obs, config)
@@ -120,6 +145,7 @@ def run(logger:Logger, reflexion:Reflexion, trial_start:int, config:dict):
             reflexion.add_histories("relative_observation", relative)
 
             env.now_step = step
+            usage.set_context(trial, step)
 
             # 行動を決定し実行する
             actions, response = policy.get_action(env, reflexion, config)
@@ -140,40 +166,46 @@ def run(logger:Logger, reflexion:Reflexion, trial_start:int, config:dict):
             })
 
             logger.clear()
-            logger.append({"init" : log_init, "steps" : log_steps,})
-            logger.output(f"log_trial{trial}")
-
-            histories = make_history_log(env)
-            logger.output(f"log_history_trial{trial}", histories)
+            logger.append({"init" : log_init, "steps" : list(log_steps),})
+            submit_log(trial)
+            submit_history_log(trial)
 
             # 終了していたら打ち切る
             if done: break
 
         # 最終状態の描画
         movie_maker.render()
-        movie_maker.make(f"capture_trial{trial}")
+        submit_movie(trial)
 
         # サブゴールの達成判定
+        usage.set_context(trial)
         log_finalize = {}
         finalize_subgoal(env, is_success, log_finalize)
 
         # 結果を履歴に追加
         reflexion.add_result(is_success)
-        histories = make_history_log(env)
-        logger.output(f"log_history_trial{trial}", histories)
+        submit_history_log(trial)
 
         # reflexionを実行
         print("\n[info] running reflexion...")
         queries = reflexion.run(is_success, reason, config)
 
         # ログなどの処理
+        if len(reflexion.trim_logs) > 0:
+            dropped_tokens = sum(log["dropped_tokens"] for log in reflexion.trim_logs)
+            print(f"[info] trimmed {dropped_tokens} tokens of history in {len(reflexion.trim_logs)} prompts to fit prompt_token_budget")
         subgoals_dict = [tree.get_dict() for tree in reflexion.subgoal_trees]
         history_dict = [history.get_dict() for history in reflexion.histories]
         memory_dict = [memory.get_dict() for memory in reflexion.memories]
-        logger.append({"history":history_dict, "finallize_subgoal":log_finalize, "subgoal_tree": subgoals_dict, "reflexion_queries":queries, "memory": memory_dict})
-        logger.output(f"log_trial{trial}")
-        logger.output(f"reflexion_backup", {"memory" : memory_dict, "trial": trial})
-        subgoal_visualize(logger.path, [trial])
+        logger.append({"history":history_dict, "finallize_subgoal":log_finalize, "subgoal_tree": subgoals_dict, "reflexion_queries":queries, "memory": memory_dict, "llm_usage": usage.summarize(trial), "prompt_trimming": reflexion.trim_logs})
+        submit_log(trial)
+        worker.submit(usage.to_csv, logger.make_path(f"llm_usage_trial{trial}.csv"), trial)
+        worker.submit(logger.output, f"reflexion_backup", {"memory" : memory_dict, "trial": trial})
+        worker.submit(subgoal_visualize, logger.path, [trial])
+
+        # 次のTrialは前のTrialのログを読むことがあるので, 出力が全て終わるまで待つ
+        worker.flush()
+    worker.close()
 
 def main():
     # 指定したconfigを連続で実行する
@@ -0,0 +1,143 @@
+import sys
+import os
+# カスタマイズしたライブラリは作業フォルダから優先的に参照する
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+import csv
+import json
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# 複数のプロセスでTrialやconfigを並列に実行する
+# Reflexionを行わない("reflexion_type"が"none")かつ前のTrialのログを使わない設定では, Trialを分割して各プロセスで実行する
+# それ以外の設定はTrialの順番に意味があるので, configやシードの単位で並列に実行する
+# 結果のフォルダ構成はmain.pyと同じで, 全ての実行が終わった後に各Trialの結果をまとめる
+# 各プロセスがモデルを読み込むので, ローカルのモデルを使う場合は推論サーバ("server:モデル名")を共有するとよい
+
+# Trialの順番に依存せずに実行できるか
+def is_trial_independent(config:dict) -> bool:
+    from utils.utils import get_value
+    if get_value(config, "reflexion_type", "general") != "none": return False
+    # 最初のサブゴールを前のTrialのログから作る場合は順番に依存する
+    return not get_value(config, "is_use_init_subgoal", False)
+
+# ディスク上のキャッシュ(応答, 潜在表現)は複数のプロセスから同時に書き込めないので, 実行単位ごとに別のフォルダを使う
+# 同じ入力が何度目に現れたかも実行単位ごとに数えるので, 同じ--workersと--seedsで実行し直せば同じキャッシュを参照する
+def get_shard_config(config:dict, trial_start:int, trial_end:int) -> dict:
+    from utils.utils import get_value
+    config = dict(config)
+    shard_name = f"{config['config_name']}_trial{trial_start}-{trial_end-1}"
+    if get_value(config, "llm_cache_mode", "off") != "off":
+        config["llm_cache_dir"] = os.path.join(get_value(config, "llm_cache_dir", "./llm_cache/"), shard_name)
+    if get_value(config, "representation_cache_dir", None) is not None:
+        config["representation_cache_dir"] = os.path.join(config["representation_cache_dir"], shard_name)
+    return config
+
+# 1つのプロセスで実行する処理(子プロセスでmainを読み込むので, 重いライブラリはここで初めてimportされる)
+def run_shard(config:dict, path:str, trial_start:int, trial_end:int):
+    from main import run
+    from logger.logger import Logger
+    from utils.llm_utils import LLM
+    from utils.embedding_utils import Embedder
+    from utils.utils import get_value
+
+    config = get_shard_config(config, trial_start, trial_end)
+    LLM.load(config)
+    if get_value(config, "is_use_embedding_model", False):
+        Embedder.load(config)
+    print(f"------ execute {config['config_name']} trial {trial_start}-{trial_end-1} ------")
+    logger = Logger(path, config["config_name"], False)
+    run(logger, None, trial_start, {**config, "trial_count": trial_end})
+    return path, trial_start, trial_end
+
+# Trialを連続した範囲にほぼ均等に分ける
+def split_trials(trial_count:int, shard_count:int) -> list[tuple[int, int]]:
+    shard_count = max(1, min(shard_count, trial_count))
+    bounds = [trial_count * i // shard_count for i in range(shard_count + 1)]
+    return [(bounds[i], bounds[i+1]) for i in range(shard_count) if bounds[i] < bounds[i+1]]
+
+# 各Trialの結果を1つのフォルダにまとめる
+# 使用量のCSVを結合し, 成功したかどうかの一覧と, 最後のTrialのReflexionのバックアップを出力する
+def merge_results(path:str, trial_count:int):
+    from logger.logger import output
+    summary = []
+    usage_rows = []
+    fieldnames = None
+    for trial in range(trial_count):
+        log_path = f"{path}/log_trial{trial}.json"
+        if not os.path.exists(log_path):
+            print(f"[Warn] {log_path} doesn't exist")
+            continue
+        with open(log_path) as f:
+            log = json.load(f)
+        steps = log[0]["steps"]
+        summary.append({
+            "trial": trial,
+            "is_success": steps[-1]["is_success"] if len(steps) > 0 else False,
+            "reason": steps[-1]["reason"] if len(steps) > 0 else "",
+            "length": len(steps),
+        })
+        if len(log) > 1:
+            output({"memory": log[1]["memory"], "trial": trial}, f"{path}/reflexion_backup.json")
+
+        usage_path = f"{path}/llm_usage_trial{trial}.csv"
+        if os.path.exists(usage_path):
+            with open(usage_path, newline='') as f:
+                reader = csv.DictReader(f)
+                fieldnames = reader.fieldnames
+                usage_rows.extend(reader)
+
+    success_count = sum(int(s["is_success"]) for s in summary)
+    output({
+        "success_rate": success_count / len(summary) if len(summary) > 0 else 0.0,
+        "trials": summary,
+    }, f"{path}/summary.json")
+    if fieldnames is not None:
+        with open(f"{path}/llm_usage.csv", 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(usage_rows)
+    print(f"[info] merged {len(summary)} trials in {path}: success {success_count}/{len(summary)}")
+
+def main():
+    from main import load_config, make_logger
+    from executed_configs import configs
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--configs", nargs="+", default=configs, help="実行するconfig名(省略時はexecuted_configs.pyのconfigs)")
+    parser.add_argument("--workers", type=int, default=2, help="並列に実行するプロセス数")
+    parser.add_argument("--seeds", type=int, nargs="+", default=None, help="configごとに\"env_fixed_seed\"を変えて実行するシード")
+    args = parser.parse_args()
+
+    # 実行する設定(configとシードの組)ごとに結果のフォルダを作り, 実行単位に分ける
+    jobs = []
+    results = {}
+    for config_name in args.configs:
+        base_config = load_config(config_name)
+        seeds = args.seeds if args.seeds is not None else [None]
+        for seed in seeds:
+            config = dict(base_config)
+            if seed is not None:
+                config["env_fixed_seed"] = seed
+                config["config_name"] = f"{config_name}_seed{seed}"
+            path = make_logger(config).path[:-1]
+            results[path] = config["trial_count"]
+            if is_trial_independent(config):
+                jobs.extend((config, path, start, end) for start, end in split_trials(config["trial_count"], args.workers))
+            else:
+                jobs.append((config, path, 0, config["trial_count"]))
+
+    # CUDAを使う子プロセスはforkでは作れないのでspawnを使う
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as executor:
+        futures = [executor.submit(run_shard, *job) for job in jobs]
+        for future in as_completed(futures):
+            path, start, end = future.result()
+            print(f"[info] finished trial {start}-{end-1} in {path}")
+
+    for path, trial_count in results.items():
+        merge_results(path, trial_count)
+
+if __name__ == "__main__":
+    main()
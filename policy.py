@@ -21,24 +21,30 @@ def command_policy(env:gym.Env, reflexion:Reflexion, info:dict, params:dict={})
 def random_policy(env:gym.Env, reflexion:Reflexion, info:dict, params:dict={}) -> list[int]:
     return env.action_space.sample()
 
+# 状況について考えてから行動する
+# "is_use_fused_consideration"がTrueなら, 思考と行動を1回の呼び出しでまとめて生成する
+def consider_and_act(env:gym.Env, reflexion:Reflexion, info:dict, params:dict={}) -> list[int]:
+    is_use_consideration = utils.get_value(params, "is_use_consideration", False)
+    if is_use_consideration and utils.get_value(params, "is_use_fused_consideration", False):
+        return consider_and_act_by_llm(env, reflexion, info, params)
+    consideration(env, reflexion, info, params)
+    return act_by_llm(env, reflexion, info, params)
+
 # エージェントがそれぞれ独立して行動する方策
 def simple_policy(env:gym.Env, reflexion:Reflexion, info:dict, params:dict={}) -> list[int]:
-    consideration(env, reflexion, info, params)
-    actions = act_by_llm(env, reflexion, info, params)
+    actions = consider_and_act(env, reflexion, info, params)
     return actions
 
 # エージェントが互いにメッセージを交換したあとに行動する方策
 def message_policy(env:gym.Env, reflexion:Reflexion, info:dict, params:dict={}) -> list[int]:
     message(env, reflexion, info, params)
-    consideration(env, reflexion, info, params)
-    actions = act_by_llm(env, reflexion, info, params)
+    actions = consider_and_act(env, reflexion, info, params)
     return actions
 
 # エージェントが互いに会話をしたあとに行動する方策
 def conversation_policy(env:gym.Env, reflexion:Reflexion, info:dict, params:dict={}) -> list[int]:
     conversation(env, reflexion, info, params)
-    consideration(env, reflexion, info, params)
-    actions = act_by_llm(env, reflexion, info, params)
+    actions = consider_and_act(env, reflexion, info, params)
     return actions
 
 # エージェントがnステップに一度会話を行う方策
@@ -55,8 +61,7 @@ def interval_conversation_policy(env:gym.Env, reflexion:Reflexion, info:dict, pa
             structured_conversation(env, reflexion, info, params)
         else:
             conversation(env, reflexion, info, params)
-    consideration(env, reflexion, info, params)
-    actions = act_by_llm(env, reflexion, info, params)
+    actions = consider_and_act(env, reflexion, info, params)
     
     return actions
 
@@ -74,8 +79,7 @@ def simple_subgoal_policy(env:gym.Env, reflexion:Reflexion, info:dict, params:di
     reflexion.remove_label("subgoal")
     reflexion.add_now_subgoal()
     
-    consideration(env, reflexion, info, params)
-    actions = act_by_llm(env, reflexion, info, params)
+    actions = consider_and_act(env, reflexion, info, params)
     return actions
 
 # ポリシー名と関数の紐付け
@@ -0,0 +1,126 @@
+import os
+import json
+import hashlib
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+import utils.utils as utils
+
+# LLMの応答をディスクに保存して再利用するための処理
+# 同じ実験を再実行する際のAPI料金や推論時間を削減し, replayモードではLLMなしで実験を再現する
+
+CACHE_OFF = "off"
+CACHE_READ_WRITE = "read_write"
+CACHE_REPLAY = "replay"
+# 容量を超えた場合は上限のこの割合まで削除して, 保存のたびに削除が起きないようにする
+EVICT_RATIO = 0.9
+
+# 画像(numpy配列)のハッシュ値を求める
+def get_image_hash(image) -> str:
+    if image is None: return ""
+    array = np.ascontiguousarray(image)
+    hasher = hashlib.sha256()
+    hasher.update(str((array.shape, array.dtype.str)).encode())
+    hasher.update(array.tobytes())
+    return hasher.hexdigest()
+
+# 文字列のハッシュ値を求める
+def get_text_hash(text:str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+# 内容(モデル名, 生成パラメータ, プロンプト, 画像)をキーとしてLLMの応答を保存するキャッシュ
+class ResponseCache:
+    def __init__(self, params:dict={}):
+        self.mode = utils.get_value(params, "llm_cache_mode", CACHE_OFF)
+        self.path = utils.get_value(params, "llm_cache_dir", "./llm_cache/")
+        self.max_size = int(utils.get_value(params, "llm_cache_max_mb", 1024) * 1024 * 1024)
+        assert self.mode in [CACHE_OFF, CACHE_READ_WRITE, CACHE_REPLAY]
+
+        # 同じ入力が何度目に現れたかを数えて, サンプリングによる応答の違いも再現できるようにする
+        self.occurrences: dict[str, int] = {}
+        # ファイルのパスとサイズを最終アクセスが古い順に保持する(削除のたびにフォルダを走査しないため)
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.total_size = 0
+        self.hits = 0
+        self.misses = 0
+
+        if self.is_enabled():
+            os.makedirs(self.path, exist_ok=True)
+            for file in sorted(self.get_files(), key=os.path.getmtime):
+                self.entries[file] = os.path.getsize(file)
+            self.total_size = sum(self.entries.values())
+
+    def is_enabled(self) -> bool:
+        return self.mode != CACHE_OFF
+
+    def is_replay(self) -> bool:
+        return self.mode == CACHE_REPLAY
+
+    # 入力からキャッシュのキーを生成する
+    def make_key(self, model_name:str, generation_params:dict, prompt:str, image) -> str:
+        content = json.dumps({
+            "model_name": model_name,
+            "generation_params": generation_params,
+            "prompt": get_text_hash(prompt),
+            "image": get_image_hash(image),
+        }, sort_keys=True)
+        base_key = get_text_hash(content)
+        occurrence = self.occurrences.get(base_key, 0)
+        self.occurrences[base_key] = occurrence + 1
+        return f"{base_key}_{occurrence}"
+
+    def get_file_path(self, key:str) -> str:
+        return os.path.join(self.path, key[:2], f"{key}.json")
+
+    def get_files(self) -> list[str]:
+        files = []
+        for directory, _, names in os.walk(self.path):
+            files.extend(os.path.join(directory, name) for name in names if name.endswith(".json"))
+        return files
+
+    # キャッシュから応答を取得する(見つからなければNone)
+    def get(self, key:str):
+        path = self.get_file_path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            if self.is_replay():
+                raise KeyError(f"[ERROR] Response for key '{key}' is not cached. Replay mode requires a recorded run.")
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        # 最終アクセス日時を更新してLRUの順序に反映する
+        os.utime(path)
+        if path in self.entries:
+            self.entries.move_to_end(path)
+        self.hits += 1
+        return data["text"], data["response"]
+
+    # 応答をキャッシュに保存する
+    def set(self, key:str, text:str, response):
+        if self.mode != CACHE_READ_WRITE: return
+        path = self.get_file_path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # 書き込み途中で中断しても壊れたファイルが残らないよう, 一時ファイルに書いてから置き換える
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({"text": text, "response": response}, f, default=str)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self.total_size -= self.entries.pop(path, 0)
+        self.entries[path] = os.path.getsize(path)
+        self.total_size += self.entries[path]
+        self.evict()
+
+    # 容量を超えたら最終アクセスが古いものから上限のEVICT_RATIOの割合まで削除する
+    def evict(self):
+        if self.total_size <= self.max_size: return
+        while len(self.entries) > 0 and self.total_size > self.max_size * EVICT_RATIO:
+            file, size = self.entries.popitem(last=False)
+            self.total_size -= size
+            if os.path.exists(file):
+                os.remove(file)
@@ -1,3 +1,4 @@
+import copy
 import utils.utils as utils
 from utils.embedding_utils import Embedder
 
@@ -28,6 +29,20 @@ class History(utils.Jsonable):
         self.history = []
         self.indexes = {}
 
+    # 別スレッドで文字列化するための複製(追加や削除で変わる履歴のリストだけを複製する)
+    def snapshot(self) -> 'History':
+        history = copy.copy(self)
+        history.history = list(self.history)
+        history.indexes = dict(self.indexes)
+        return history
+
+    # 特定ラベルの最新の内容(なければNone)
+    def get_latest(self, label:str):
+        for h in reversed(self.history):
+            if h['label'] == label:
+                return h['value']
+        return None
+
     # 履歴から特定ラベルの内容を消去
     def remove(self, label:str) -> None:
         self.history = [h for h in self.history if h['label'] != label]
@@ -37,10 +52,52 @@ class History(utils.Jsonable):
 
     # 必要な情報を選択して履歴を取得
     def get_str(self, length:int=-1, select:list[str]=[], counts:dict[str,int]={}) -> str:
-        contents: list[str] = []
-        contents.append(self.base_query)
-        contents.append("")
-        contents.append('The following is your history:')
+        contents = self.get_header() + [line for _, line in self.get_lines(length, select, counts)]
+        return "\n".join(contents)
+
+    # トークン数の上限に収まるように, 優先度の低いラベルの古い履歴から順に削って取得
+    # 削った結果は(削った行数, 削ったトークン数, 最終的なトークン数)として返す
+    def get_str_within_budget(self, budget:int, count_tokens, length:int=-1, select:list[str]=[], counts:dict[str,int]={}, priorities:dict[str,int]={}) -> tuple[str, dict]:
+        header = self.get_header()
+        lines = self.get_lines(length, select, counts)
+        costs = [count_tokens(line) + 1 for _, line in lines]
+        total = count_tokens("\n".join(header)) + sum(costs)
+
+        # 時刻の行は直接は削らず, その時刻の履歴が全て削られた時点で一緒に取り除く
+        count_lines = {item['step']: i for i, (item, _) in enumerate(lines) if item['label'] == 'count'}
+        remaining = {}
+        for item, _ in lines:
+            if item['label'] != 'count':
+                remaining[item['step']] = remaining.get(item['step'], 0) + 1
+        order = sorted(
+            [i for i, (item, _) in enumerate(lines) if item['label'] != 'count'],
+            key=lambda i: (utils.get_value(priorities, lines[i][0]['label'], 0), lines[i][0]['step'], i)
+        )
+        dropped = set()
+        for i in order:
+            if total <= budget: break
+            dropped.add(i)
+            total -= costs[i]
+            step = lines[i][0]['step']
+            remaining[step] -= 1
+            if remaining[step] == 0 and step in count_lines:
+                dropped.add(count_lines[step])
+                total -= costs[count_lines[step]]
+
+        contents = header + [line for i, (_, line) in enumerate(lines) if i not in dropped]
+        trimmed = {
+            "dropped_lines": len(dropped),
+            "dropped_tokens": sum(costs[i] for i in dropped),
+            "total_tokens": total,
+        }
+        return "\n".join(contents), trimmed
+
+    def get_header(self) -> list[str]:
+        return [self.base_query, "", 'The following is your history:']
+
+    # 選択された履歴の項目と, それを文字列にした行の組を取得
+    def get_lines(self, length:int=-1, select:list[str]=[], counts:dict[str,int]={}) -> list[tuple[dict, str]]:
+        lines: list[tuple[dict, str]] = []
 
         last_step = self.history[-1]['step'] if len(self.history[-1]) > 0 else 0
         if length < 0: length = last_step + 1
@@ -55,17 +112,17 @@ class History(utils.Jsonable):
             if len(select) > 0 and label not in select: continue
 
             if label == 'action':
-                contents.append(f'Your action: {value}')
+                lines.append((item, f'Your action: {value}'))
             elif label == 'result':
-                contents.append(f'result: {value}')
+                lines.append((item, f'result: {value}'))
             elif label == 'subgoal':
-                contents.append(f'subgoals: {value}')
+                lines.append((item, f'subgoals: {value}'))
             elif label == 'count':
-                contents.append(f'time {value}:')
+                lines.append((item, f'time {value}:'))
             else:
-                contents.append(str(value))
+                lines.append((item, str(value)))
 
-        return "\n".join(contents)
+        return lines
 
     # プロンプトの最初に記述する説明文を生成
     def get_base_query(self, base_query: str, task_info: str, memories: list[str]) -> str:
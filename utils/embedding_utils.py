@@ -1,19 +1,24 @@
-from sentence_transformers import SentenceTransformer, util
+from typing import TYPE_CHECKING
 from utils.utils import get_value, extraction_numbers
-from torch import Tensor
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+    from torch import Tensor
 
 # 文章の類似度を求める際に必要な機能
 # SubgoalTreeの手法でのみ用いる
+# sentence_transformers(torch)は読み込みが重いので, 実際にモデルを読み込む時までimportしない
 
 class Embedder:
     is_loaded : bool = False
-    __model : SentenceTransformer = None
+    __model : 'SentenceTransformer' = None
     __model_name : str = ""
-    __cache : dict[str, Tensor] = {}
+    __cache : dict[str, 'Tensor'] = {}
 
     # Embedding用のモデルを読み込む
     @classmethod
     def load(cls, config:dict={}):
+        from sentence_transformers import SentenceTransformer
         model_name = get_value(config, "embedding_model", "paraphrase-MiniLM-L6-v2")
         if cls.is_loaded and cls.__model_name == model_name: return
         cls.__model = SentenceTransformer(model_name)#, device="cpu")
@@ -29,11 +34,12 @@ class Embedder:
         # 含まれる数字が違ったら異なるものとして判定する(今回は座標の違いなどが大事なので)
         if extraction_numbers(text1) != extraction_numbers(text2):
             return 0
+        from sentence_transformers import util
         cosine_score = util.pytorch_cos_sim(emb1, emb2)[0][0]
         return float(cosine_score)
 
     @classmethod
-    def __get_embedding(cls, text:str) -> Tensor:
+    def __get_embedding(cls, text:str) -> 'Tensor':
         if text in cls.__cache.keys():
             return cls.__cache[text]
         embeddings = cls.__model.encode(text, convert_to_tensor=True)
@@ -213,6 +213,22 @@ def get_consideration_instr(agent_id:int, achieved:list[str], not_achieved:list[
     prompt += "\nYour think:"
     return prompt
 
+# 思考と行動を1回の応答(JSON)でまとめて生成する時のプロンプトに記述する指示文を返す
+def get_consideration_action_instr(agent_id:int, achieved:list[str], not_achieved:list[str], params:dict = {}) -> str:
+    agent_name = get_agent_name(agent_id, params)
+    image_explain = get_image_explain(agent_id, params)
+    actions_joined = get_actions_joined_str(params["env_name"], "or")
+    sentences = []
+    if params["agent_num"] > 1: sentences.append(f"You are {agent_name}.")
+    if len(image_explain) > 0: sentences.append(image_explain)
+    sentences.append("First, think about the abstract plan that would accomplish the task in the current situation in 2 to 3 sentences, briefly.")
+    sentences.append(f"Then, choose the best action to achieve your task in {actions_joined}.")
+    sentences.append('Output only JSON in the form {"thought": "your think", "action": "your action"}.')
+
+    prompt = " ".join(sentences)
+    prompt += "\nYour output:"
+    return prompt
+
 # サブゴールを生成する時のプロンプトに記述する指示文を返す
 def get_subgoal_instr(agent_id:int, achieved:list[str], not_achieved:list[str], params:dict = {}) -> str:
     agent_name = get_agent_name(agent_id, params)
@@ -377,10 +393,19 @@ def get_achievement_status(reward:int, done:bool, step:int, params:dict) -> tupl
     return False, False, ""
 
 # 現在のエージェントの視界の画像を取得
+# 描画は同じステップ内の各呼び出し(思考, 会話, 行動など)で共通なので, 環境とステップ数が同じなら使い回す
+rendered_imgs = {"env": None, "step_count": None, "imgs": None}
+
 def get_imgs(env:gym.Env, params:dict):
     is_use_vision = utils.get_value(params,"is_use_vision",False)
-    imgs = env.render_masked() if is_use_vision else [None] * env.agent_num
-    return imgs
+    if not is_use_vision:
+        return [None] * env.agent_num
+    step_count = getattr(env, "step_count", None)
+    if rendered_imgs["env"] is not env or step_count is None or rendered_imgs["step_count"] != step_count:
+        rendered_imgs["env"] = env
+        rendered_imgs["step_count"] = step_count
+        rendered_imgs["imgs"] = env.render_masked()
+    return rendered_imgs["imgs"]
 
 # 観測情報を文字列に変換する
 def obs_to_str(env:gym.Env, observation, params:dict) -> list:
@@ -445,6 +470,14 @@ def str_to_action(text:str, params:dict) -> int:
         if match: return value
 
     return 0
+
+# 生成途中の文字列から行動を特定する(正式な行動名がちょうど1つだけ現れた場合のみ行動IDを返し, それ以外はNone)
+# ストリーミング生成で行動が確定した時点で生成を打ち切るために使う
+def find_action(text:str, params:dict) -> int | None:
+    text = text.lower()
+    actions_str = get_actions_str(params["env_name"])
+    found = [i for i, action in enumerate(actions_str) if action.lower() in text]
+    return found[0] if len(found) == 1 else None
       
 # 行動IDを文字列に変換する
 def action_to_str(action_idx:int, params:dict) -> str:
@@ -0,0 +1,49 @@
+import regex
+
+# 出力形式を文法(正規表現)で制約した生成を行うための処理
+# 生成途中の文字列が文法を満たし得るかを判定し, 許されないトークンを生成させないようにする
+
+WHITESPACE = r"[ \n]{0,2}"
+INTEGER = r"-?\d{1,3}"
+NULL = "null"
+
+# 長さの上限付きのJSON文字列のパターン
+def string_pattern(max_length:int) -> str:
+    return r'"(?:[^"\\\n]|\\["\\/nt]){0,' + str(max_length) + r'}"'
+
+# 選択肢のいずれかのJSON文字列のパターン
+def enum_pattern(values:list[str]) -> str:
+    return '"(?:' + "|".join(regex.escape(value) for value in values) + ')"'
+
+def nullable_pattern(pattern:str) -> str:
+    return f"(?:{pattern}|{NULL})"
+
+# キーの順番を固定したJSONオブジェクトのパターン
+def object_pattern(fields:list[tuple[str, str]]) -> str:
+    items = [f'"{key}"{WHITESPACE}:{WHITESPACE}{value}' for key, value in fields]
+    separator = f"{WHITESPACE},{WHITESPACE}"
+    return WHITESPACE + r"\{" + WHITESPACE + separator.join(items) + WHITESPACE + r"\}"
+
+# 構造化通信(policy_utils.structured_conversation)のスキーマ
+STRUCTURED_MESSAGE_FIELDS = [
+    ("intent", enum_pattern(["PROPOSE", "INFORM", "REQUEST", "AGREE", "REJECT"])),
+    ("target_object", nullable_pattern(string_pattern(40))),
+    ("target_coordinate", nullable_pattern(r"\[" + WHITESPACE + INTEGER + WHITESPACE + "," + WHITESPACE + INTEGER + WHITESPACE + r"\]")),
+    ("action_plan", string_pattern(200)),
+    ("message", string_pattern(300)),
+]
+
+# 文法を満たすかどうかを判定するクラス
+class Grammar:
+    def __init__(self, pattern:str):
+        self.pattern = regex.compile(pattern)
+
+    # 続きを生成すれば文法を満たし得るか
+    def is_valid_prefix(self, text:str) -> bool:
+        return self.pattern.fullmatch(text, partial=True) is not None
+
+    # 文法を満たして完結しているか
+    def is_complete(self, text:str) -> bool:
+        return self.pattern.fullmatch(text) is not None
+
+STRUCTURED_MESSAGE_GRAMMAR = Grammar(object_pattern(STRUCTURED_MESSAGE_FIELDS))
@@ -0,0 +1,83 @@
+import os
+import utils.utils as utils
+from utils.llm_utils import LLM
+from utils.registry_utils import ModelRegistry, load_timer
+
+from transformers import (
+    AutoModelForSeq2SeqLM,
+    AutoTokenizer,
+)
+
+import torch
+import ENV
+
+# Flan-T5などのSeq2Seqモデルを使うLLM
+# utils/llm_utils.pyのLLMから, モデル名に応じて読み込まれる
+# 生成設定は"generation_profiles"に加えて, "flan_generation_params"でmodel.generateの引数(top_k, num_beamsなど)を直接指定できる
+
+class Flan(LLM):
+    default_generation_params = {
+        "max_new_tokens": 64,
+        "do_sample": True,
+        "temperature": 0.9,
+        "top_p": 0.6,
+    }
+
+    def __init__(self, model_name, params:dict={}):
+        super().__init__(model_name, params)
+        token = os.environ.get("HF_TOKEN")
+        self._load_tokenizer(model_name)
+
+        cpu_threads = utils.get_value(params, "llm_cpu_threads", None)
+        if cpu_threads is not None:
+            torch.set_num_threads(cpu_threads)
+        key = (model_name, torch.cuda.is_available(), utils.get_value(params, "llm_use_safetensors", None))
+        self.model = ModelRegistry.get(key, lambda: self._load_model(model_name, params, token))
+
+    @classmethod
+    def _get_generation_params(cls, params:dict) -> dict:
+        return {**cls.default_generation_params, **utils.get_value(params, "flan_generation_params", {})}
+
+    def _load_tokenizer(self, model_name):
+        with load_timer(f"load tokenizer of {model_name}"):
+            self.tokenizer = AutoTokenizer.from_pretrained(model_name, cache_dir=ENV.model_dir, token=os.environ.get("HF_TOKEN"))
+
+    # T5系はfloat16だとオーバーフローしやすいので, GPUではbfloat16, CPUではfloat32で読み込む
+    def _load_model(self, model_name, params:dict, token):
+        is_cuda = torch.cuda.is_available()
+        model = AutoModelForSeq2SeqLM.from_pretrained(
+            model_name,
+            torch_dtype=torch.bfloat16 if is_cuda else torch.float32,
+            cache_dir=ENV.model_dir,
+            low_cpu_mem_usage=True,
+            use_safetensors=utils.get_value(params, "llm_use_safetensors", None),
+            token=token,
+        )
+        return model.to("cuda" if is_cuda else "cpu").eval()
+
+    # ビームサーチはstreamerに対応していないので, その場合は時間の計測を省く
+    def _get_generate_kwargs(self) -> dict:
+        kwargs = super()._get_generate_kwargs()
+        if kwargs.get("num_beams", 1) > 1:
+            kwargs.pop("streamer")
+        return kwargs
+
+    def _generate_text(self, prompt):
+        return self._generate_text_batch([prompt], [None])[0]
+
+    # エンコーダへの入力は右側をパディングし, batch_size件ずつまとめて生成する
+    def _generate_text_batch(self, prompts, images):
+        results = []
+        for start in range(0, len(prompts), self.batch_size):
+            chunk = prompts[start:start+self.batch_size]
+            inputs = self.tokenizer(chunk, return_tensors="pt", padding=True).to(self.model.device)
+            with torch.no_grad():
+                output = self.model.generate(
+                    **inputs,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    **self._get_generate_kwargs(),
+                )
+            texts = self.tokenizer.batch_decode(output, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+            for text in texts:
+                results.append((text.strip(), [{"generated_text": text}]))
+        return results
@@ -0,0 +1,210 @@
+import time
+import random
+import asyncio
+import utils.utils as utils
+from utils.llm_utils import LLM, SERVER_PREFIX
+
+import openai
+from openai import AsyncOpenAI
+import tiktoken
+
+import ENV
+
+# OpenAIのAPI(およびOpenAI互換の推論サーバ)を使うLLM
+# utils/llm_utils.pyのLLMから, モデル名に応じて読み込まれる
+
+# 1分あたりの上限をもとにリクエスト数やトークン数を制限するトークンバケット(Noneか0以下なら制限しない)
+class TokenBucket:
+    def __init__(self, per_minute:int):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60 if self.is_limited() else 0
+        self.updated = time.monotonic()
+
+    def is_limited(self) -> bool:
+        return self.capacity is not None and self.capacity > 0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # 指定量を消費する(足りなければ補充されるまで待つ)
+    async def acquire(self, amount:int=1):
+        if not self.is_limited(): return
+        amount = min(amount, self.capacity)
+        while True:
+            self.refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    # 見積もりとの差分などを後から消費する(マイナスになった分は次の取得が待たされる)
+    def consume(self, amount:int):
+        if not self.is_limited(): return
+        self.refill()
+        self.tokens -= amount
+
+class Gpt(LLM):
+    # 再試行する一時的なエラー
+    retry_errors = (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )
+
+    def __init__(self, model_name, params:dict={}):
+        super().__init__(model_name, params)
+        self.client = AsyncOpenAI(
+            api_key = ENV.openai_api_key,
+            base_url = utils.get_value(params, "openai_base_url", None),
+            max_retries = 0
+        )
+        self._load_tokenizer(model_name)
+        self.api_model_name = model_name
+        self.input_token = 0
+        self.output_token = 0
+
+        # 並行リクエスト数とレート制限の設定
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = asyncio.Semaphore(utils.get_value(params, "openai_max_concurrency", 8))
+        self.request_bucket = TokenBucket(utils.get_value(params, "openai_requests_per_minute", 500))
+        self.token_bucket = TokenBucket(utils.get_value(params, "openai_tokens_per_minute", 30000))
+        self.max_retries = utils.get_value(params, "openai_max_retries", 5)
+        self.retry_wait = utils.get_value(params, "openai_retry_wait", 1.0)
+    
+    # 生成設定をAPIの引数に変換する
+    # 停止文字列はAPIに渡すと出力から取り除かれてしまうため, LLM._truncate_at_stopでの打ち切りのみとする
+    @classmethod
+    def _apply_profile(cls, generation_params:dict, profile:dict) -> dict:
+        params = dict(generation_params)
+        if "max_new_tokens" in profile:
+            params["max_completion_tokens"] = profile["max_new_tokens"]
+        for key in ["temperature", "top_p"]:
+            if key in profile:
+                params[key] = profile[key]
+        return params
+
+    def _load_tokenizer(self, model_name):
+        try:
+            self.encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding("o200k_base")
+
+    def _count_tokens(self, text:str) -> int:
+        return len(self.encoding.encode(text))
+
+    def _prompt_format(self, prompt, image = None):
+        if image is None: return super()._prompt_format(prompt)
+
+        image_base64 = utils.np_image_to_base64(image)
+        return [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": {"url":  f"data:image/jpeg;base64,{image_base64}"}}
+            ]
+        }]
+
+    # レート制限を守りながらAPIを呼び出し, 一時的なエラーは間隔を伸ばしながら再試行する
+    # トークン数の見積もりは最初に1度だけ消費し, 実際の使用量との差分は応答を受け取った後に反映する
+    async def _create_async(self, prompt, image, estimated_token:int, **kwargs):
+        messages = self._prompt_format(prompt, image)
+        await self.token_bucket.acquire(estimated_token)
+        for attempt in range(self.max_retries + 1):
+            await self.request_bucket.acquire()
+            try:
+                return await self.client.chat.completions.create(
+                    model = self.api_model_name,
+                    messages = messages,
+                    **self.generation_params,
+                    **kwargs
+                )
+            except self.retry_errors as e:
+                if attempt == self.max_retries: raise
+                wait = self.retry_wait * (2 ** attempt) + random.uniform(0, self.retry_wait)
+                print(f"[Warn] {type(e).__name__} from OpenAI API, retrying in {wait:.1f}s")
+                await asyncio.sleep(wait)
+
+    async def _call_api_async(self, prompt, image = None):
+        estimated_token = len(self.encoding.encode(prompt))
+        async with self.semaphore:
+            response = await self._create_async(prompt, image, estimated_token)
+        text = response.choices[0].message.content
+
+        # 使用トークン数を記録する
+        info = {}
+        if response.usage is not None:
+            self.input_token += response.usage.prompt_tokens
+            self.output_token += response.usage.completion_tokens
+            self.token_bucket.consume(response.usage.total_tokens - estimated_token)
+            info = {"input_token": response.usage.prompt_tokens, "output_token": response.usage.completion_tokens}
+        return text, info
+
+    def _call_api(self, prompt, image = None):
+        return self.loop.run_until_complete(self._call_api_async(prompt, image))
+
+    def _generate_text(self, prompt):
+        return self._call_api(prompt)
+
+    def _generate_text_with_vision(self, prompt, image):
+        return self._call_api(prompt, image)
+
+    # 独立したリクエストを並行に投げる
+    def _generate_text_batch(self, prompts, images):
+        return self.loop.run_until_complete(self._call_api_batch_async(prompts, images))
+
+    # 1つでも失敗したら残りのリクエストを取り消してから例外を送出する(レート制限の枠を使い続けないように)
+    async def _call_api_batch_async(self, prompts, images):
+        tasks = [asyncio.ensure_future(self._call_api_async(prompt, image)) for prompt, image in zip(prompts, images)]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    # stream=Trueで受け取った差分を順に返す(途中で閉じられたら接続を切って生成を打ち切る)
+    def _generate_text_stream(self, prompt, image):
+        estimated_token = len(self.encoding.encode(prompt))
+        stream = self.loop.run_until_complete(self._create_async(prompt, image, estimated_token, stream=True))
+        try:
+            while True:
+                try:
+                    chunk = self.loop.run_until_complete(stream.__anext__())
+                except StopAsyncIteration:
+                    break
+                if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            self.loop.run_until_complete(stream.close())
+
+# ローカルで常駐している推論サーバ(llm_server.py)を使うLLM
+# 複数の実験プロセスで1つの読み込み済みモデルとリクエストキューを共有する
+class LocalServer(Gpt):
+    prefix = SERVER_PREFIX
+
+    def __init__(self, model_name, params:dict={}):
+        server_params = {
+            "openai_requests_per_minute": 0,
+            "openai_tokens_per_minute": 0,
+            **params,
+            "openai_base_url": utils.get_value(params, "llm_server_url", "http://127.0.0.1:8000/v1"),
+        }
+        super().__init__(model_name, server_params)
+        self.api_model_name = model_name[len(self.prefix):]
+
+    # llm_server.pyはstreamに対応していないので, 応答全体を1度に返す
+    def _generate_text_stream(self, prompt, image):
+        yield from LLM._generate_text_stream(self, prompt, image)
+
+    # サーバ側はHugging Faceのモデルなので, 停止文字列もそのまま渡す
+    @classmethod
+    def _apply_profile(cls, generation_params:dict, profile:dict) -> dict:
+        params = super()._apply_profile(generation_params, profile)
+        if "stop" in profile:
+            params["stop"] = profile["stop"]
+        return params
@@ -0,0 +1,575 @@
+import copy
+import threading
+import utils.utils as utils
+from utils.llm_utils import LLM
+from utils.grammar_utils import Grammar, STRUCTURED_MESSAGE_GRAMMAR
+from utils.registry_utils import ModelRegistry, load_timer
+
+import transformers
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    BitsAndBytesConfig,
+    MllamaForConditionalGeneration,
+    LlavaNextForConditionalGeneration,
+    AutoProcessor,
+    LlavaNextProcessor,
+    DynamicCache,
+    LogitsProcessor,
+    LogitsProcessorList,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer
+)
+
+import torch
+import ENV
+
+# Hugging FaceのLlama系モデル(Llama, Llama Vision, LLaVA)を使うLLM
+# utils/llm_utils.pyのLLMから, モデル名に応じて読み込まれる
+
+# 文法を満たし得ないトークンを生成させないためのLogitsProcessor
+class GrammarLogitsProcessor(LogitsProcessor):
+    def __init__(self, grammar:Grammar, tokenizer, prompt_len:int, eos_token_ids:list[int], top_k:int=64):
+        self.grammar = grammar
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.eos_token_ids = eos_token_ids
+        self.top_k = top_k
+        self.token_strs: dict[int, str] = {}
+
+    def get_token_str(self, token_id:int) -> str:
+        if token_id not in self.token_strs:
+            self.token_strs[token_id] = self.tokenizer.decode([token_id])
+        return self.token_strs[token_id]
+
+    def is_allowed(self, text:str, token_id:int) -> bool:
+        if token_id in self.eos_token_ids: return False
+        token_str = self.get_token_str(token_id)
+        return len(token_str) > 0 and self.grammar.is_valid_prefix(text + token_str)
+
+    def __call__(self, input_ids, scores):
+        for row in range(input_ids.shape[0]):
+            text = self.tokenizer.decode(input_ids[row, self.prompt_len:], skip_special_tokens=True)
+            if self.grammar.is_complete(text):
+                allowed = list(self.eos_token_ids)
+            else:
+                # まずは上位のトークンから探し, 見つからなければ語彙全体を確率順に探す
+                candidates = torch.topk(scores[row], min(self.top_k, scores.shape[-1])).indices.tolist()
+                allowed = [token_id for token_id in candidates if self.is_allowed(text, token_id)]
+                if len(allowed) == 0:
+                    for token_id in torch.argsort(scores[row], descending=True).tolist():
+                        if self.is_allowed(text, token_id):
+                            allowed = [token_id]
+                            break
+            mask = torch.full_like(scores[row], float("-inf"))
+            mask[allowed] = 0
+            scores[row] = scores[row] + mask
+        return scores
+
+# 文法を満たして完結した時点で生成を打ち切る
+class GrammarStoppingCriteria(StoppingCriteria):
+    def __init__(self, grammar:Grammar, tokenizer, prompt_len:int):
+        self.grammar = grammar
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+
+    def __call__(self, input_ids, scores, **kwargs):
+        texts = self.tokenizer.batch_decode(input_ids[:, self.prompt_len:], skip_special_tokens=True)
+        is_done = [self.grammar.is_complete(text) for text in texts]
+        return torch.tensor(is_done, device=input_ids.device)
+
+# 外部から停止を指示されたら生成を打ち切る(ストリーミング生成の途中終了用)
+class CancelCriteria(StoppingCriteria):
+    def __init__(self, event:threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+# generateには1つのstreamerしか渡せないので, 複数のstreamerにまとめて転送する
+class StreamerGroup:
+    def __init__(self, streamers:list):
+        self.streamers = streamers
+
+    def put(self, value):
+        for streamer in self.streamers:
+            streamer.put(value)
+
+    def end(self):
+        for streamer in self.streamers:
+            streamer.end()
+
+class Llama(LLM):
+    default_generation_params = {
+        "max_new_tokens": 256,
+        "do_sample": True,
+        "temperature": 0.6,
+        "top_p": 0.9,
+    }
+    is_support_scoring = True
+
+    def __init__(self, model_name, params:dict={}):
+        super().__init__(model_name, params)
+
+        self._load_tokenizer(model_name)
+        self.model = self._get_model(model_name, params)
+
+        self.pipeline = transformers.pipeline(
+            "text-generation",
+            model=self.model,
+            tokenizer=self.tokenizer,
+            model_kwargs={"torch_dtype": torch.bfloat16},
+        )
+        self.terminators = [
+            self.pipeline.tokenizer.eos_token_id,
+            self.pipeline.tokenizer.convert_tokens_to_ids("<|eot_id|>")
+        ]
+
+        # 直近のプロンプトのKVキャッシュを保持し, 共通する接頭辞の再計算を省く
+        # 1つあたりプロンプト全体のKVキャッシュ(7Bモデルで長い履歴なら数百MB〜1GB程度)を複製して持つので, 既定では1つだけ保持する
+        self.is_use_prefix_cache = utils.get_value(params, "is_use_prefix_cache", False)
+        self.prefix_cache_size = utils.get_value(params, "prefix_cache_size", 1)
+        self.prefix_caches: list[dict] = []
+
+        # 選択肢の尤度をトークン数で正規化するか("sum" or "mean")
+        self.score_normalize = utils.get_value(params, "action_score_normalize", "sum")
+
+        # 小さいモデル(同じトークナイザを持つもの)で候補を先に生成し, 本体のモデルでまとめて検証する
+        self.draft_model = None
+        draft_model_name = utils.get_value(params, "llm_draft_model", None)
+        if draft_model_name is not None:
+            self.draft_model = self._get_model(draft_model_name, params)
+            num_assistant_tokens = utils.get_value(params, "draft_num_assistant_tokens", None)
+            if num_assistant_tokens is not None:
+                self.draft_model.generation_config.num_assistant_tokens = num_assistant_tokens
+            if self.is_use_prefix_cache:
+                print("[Warn] is_use_prefix_cache is ignored while llm_draft_model is set")
+                self.is_use_prefix_cache = False
+
+    def _load_tokenizer(self, model_name):
+        with load_timer(f"load tokenizer of {model_name}"):
+            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        # バッチ生成では左側をパディングする
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+    # 同じ設定で読み込んだ重みはプロセス内で使い回し, 初めて読み込んだ場合は指定があれば慣らし運転をする
+    def _get_model(self, model_name, params:dict):
+        cpu_threads = utils.get_value(params, "llm_cpu_threads", None)
+        if cpu_threads is not None:
+            torch.set_num_threads(cpu_threads)
+        key = (
+            model_name,
+            torch.cuda.is_available(),
+            utils.get_value(params, "llm_cpu_quantization", "none"),
+            utils.get_value(params, "llm_use_safetensors", None),
+        )
+        warmup = self._warmup if utils.get_value(params, "llm_warmup", False) else None
+        return ModelRegistry.get(key, lambda: self._load_model(model_name, params), warmup)
+
+    # 最初の生成で行われるカーネルの準備などを先に済ませるため, 短い生成を1度行う
+    def _warmup(self, model):
+        inputs = self.tokenizer(["Hello"], return_tensors="pt", add_special_tokens=False).to(model.device)
+        with torch.no_grad():
+            model.generate(**inputs, max_new_tokens=4, do_sample=False, pad_token_id=self.tokenizer.pad_token_id)
+
+    # 環境に応じて読み込み設定を切り替える
+    # "llm_use_safetensors"を指定するとsafetensors形式の重みを使う(ファイルをmemmapで開くので, 読み込みが速くページキャッシュも共有される)
+    def _load_model(self, model_name, params:dict):
+        use_safetensors = utils.get_value(params, "llm_use_safetensors", None)
+        if torch.cuda.is_available():
+            quantization_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16
+            )
+
+            return AutoModelForCausalLM.from_pretrained(
+                model_name,
+                quantization_config=quantization_config,
+                cache_dir=ENV.model_dir,
+                low_cpu_mem_usage=True,
+                use_safetensors=use_safetensors
+            )
+        return self._load_cpu_model(model_name, params)
+    
+    # CUDAがない環境での読み込み
+    # "llm_cpu_quantization"が"int8"なら線形層の重みをint8に動的量子化し, それ以外はbfloat16のまま読み込む
+    def _load_cpu_model(self, model_name, params:dict):
+        use_safetensors = utils.get_value(params, "llm_use_safetensors", None)
+        quantization = utils.get_value(params, "llm_cpu_quantization", "none")
+        assert quantization in ["none", "int8"]
+        if quantization == "none":
+            return AutoModelForCausalLM.from_pretrained(
+                model_name,
+                torch_dtype=torch.bfloat16,
+                cache_dir=ENV.model_dir,
+                low_cpu_mem_usage=True,
+                use_safetensors=use_safetensors,
+                device_map="auto"
+            )
+
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=torch.bfloat16,
+            cache_dir=ENV.model_dir,
+            low_cpu_mem_usage=True,
+            use_safetensors=use_safetensors
+        )
+        # float32への変換は1層ずつ行い, モデル全体をfloat32で持つことによるメモリの増加を避ける
+        for module in list(model.modules()):
+            for child_name, child in list(module.named_children()):
+                if isinstance(child, torch.nn.Linear):
+                    child.float()
+                    child.qconfig = torch.ao.quantization.default_dynamic_qconfig
+                    setattr(module, child_name, torch.ao.nn.quantized.dynamic.Linear.from_float(child))
+        # 量子化した線形層の出力はfloat32なので, 埋め込みや正規化層もfloat32に揃える
+        return model.float().eval()
+
+    def _generate_text(self, prompt):
+        message = self._prompt_format(prompt)
+        query = self.pipeline.tokenizer.apply_chat_template(
+            message,
+            tokenize=False,
+            add_generation_prompt=True
+        )
+        if self.is_use_prefix_cache:
+            return self._generate_text_with_prefix_cache(query)
+        return self._generate_text_batch([prompt], [None])[0]
+
+    # 保持しているKVキャッシュのうち, 入力と最も長く接頭辞が一致するものを探す
+    def _find_prefix_cache(self, input_ids) -> tuple[int, dict]:
+        best_len, best_entry = 0, None
+        for entry in self.prefix_caches:
+            cached_ids = entry["ids"]
+            # 最低1トークンは新たに入力する必要がある
+            n = min(len(cached_ids), len(input_ids) - 1)
+            mismatch = (cached_ids[:n] != input_ids[:n]).nonzero()
+            common_len = int(mismatch[0]) if len(mismatch) > 0 else n
+            if common_len > best_len:
+                best_len, best_entry = common_len, entry
+        return best_len, best_entry
+
+    # 共通接頭辞のKVキャッシュを再利用し, 新しい部分だけをprefillして生成する
+    def _generate_text_with_prefix_cache(self, query):
+        input_ids = self.tokenizer(query, return_tensors="pt", add_special_tokens=False)["input_ids"][0].to(self.model.device)
+        common_len, entry = self._find_prefix_cache(input_ids)
+
+        cache = DynamicCache()
+        if entry is not None:
+            # 生成時にキャッシュが書き換えられるので複製して使う
+            cache = copy.deepcopy(entry["cache"])
+            cache.crop(common_len)
+
+        with torch.no_grad():
+            output = self.model.generate(
+                input_ids=input_ids[None],
+                attention_mask=torch.ones_like(input_ids)[None],
+                past_key_values=cache,
+                eos_token_id=self.terminators,
+                pad_token_id=self.tokenizer.pad_token_id,
+                **self._get_generate_kwargs(),
+                return_dict_in_generate=True,
+            )
+
+        # プロンプト部分のキャッシュだけを残して保存する
+        prompt_cache = output.past_key_values
+        prompt_cache.crop(len(input_ids))
+        if entry is not None:
+            self.prefix_caches.remove(entry)
+            # 以前のプロンプトを丸ごと含む場合は置き換え, そうでなければ最近使ったものとして残す
+            if common_len < len(entry["ids"]):
+                self.prefix_caches.append(entry)
+        self.prefix_caches.append({"ids": input_ids, "cache": prompt_cache})
+        if len(self.prefix_caches) > self.prefix_cache_size:
+            self.prefix_caches.pop(0)
+
+        text = self.tokenizer.decode(output.sequences[0][len(input_ids):], skip_special_tokens=True)
+        response = [{"generated_text": query + text, "cached_prefix_tokens": common_len}]
+        return text, response
+
+    # パディングしたバッチでまとめてデコードする
+    def _generate_text_batch(self, prompts, images):
+        # 接頭辞キャッシュを使う場合はprefillの削減を優先して1件ずつ生成する
+        if self.is_use_prefix_cache:
+            return [self._generate_text(prompt) for prompt in prompts]
+        queries = [
+            self.tokenizer.apply_chat_template(
+                self._prompt_format(prompt),
+                tokenize=False,
+                add_generation_prompt=True
+            ) for prompt in prompts
+        ]
+        # 下書きモデルを使う生成(assisted generation)はバッチサイズ1にしか対応していない
+        batch_size = self.batch_size
+        assisted_kwargs = {}
+        if self.draft_model is not None:
+            batch_size = 1
+            assisted_kwargs = {"assistant_model": self.draft_model}
+        results = []
+        for start in range(0, len(queries), batch_size):
+            chunk = queries[start:start+batch_size]
+            inputs = self.tokenizer(
+                chunk,
+                return_tensors="pt",
+                padding=True,
+                padding_side="left",
+                add_special_tokens=False
+            ).to(self.model.device)
+            with torch.no_grad():
+                output = self.model.generate(
+                    **inputs,
+                    eos_token_id=self.terminators,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    **assisted_kwargs,
+                    **self._get_generate_kwargs(),
+                )
+            input_len = inputs["input_ids"].shape[1]
+            texts = self.tokenizer.batch_decode(output[:, input_len:], skip_special_tokens=True)
+            for query, text in zip(chunk, texts):
+                results.append((text, [{"generated_text": query + text}]))
+        return results
+    
+    # 別スレッドで生成し, デコードできた文字列から順に返す
+    # 呼び出し側がジェネレータを閉じたら次のトークンで生成を打ち切る
+    def _generate_text_stream(self, prompt, image):
+        query = self.tokenizer.apply_chat_template(
+            self._prompt_format(prompt),
+            tokenize=False,
+            add_generation_prompt=True
+        )
+        inputs = self.tokenizer(query, return_tensors="pt", add_special_tokens=False).to(self.model.device)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        cancel = threading.Event()
+        kwargs = self._get_generate_kwargs()
+        kwargs["streamer"] = StreamerGroup([kwargs["streamer"], streamer])
+        if self.draft_model is not None:
+            kwargs["assistant_model"] = self.draft_model
+        errors = []
+
+        def run():
+            try:
+                with torch.no_grad():
+                    self.model.generate(
+                        **inputs,
+                        stopping_criteria=StoppingCriteriaList([CancelCriteria(cancel)]),
+                        eos_token_id=self.terminators,
+                        pad_token_id=self.tokenizer.pad_token_id,
+                        **kwargs,
+                    )
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            for text in streamer:
+                yield text
+        finally:
+            cancel.set()
+            for _ in streamer: pass
+            thread.join()
+        if len(errors) > 0:
+            raise errors[0]
+
+    # JSONスキーマを1トークンずつ強制しながら生成し, オブジェクトが閉じた時点で止める
+    def _generate_structured(self, prompt, image):
+        query = self.tokenizer.apply_chat_template(
+            self._prompt_format(prompt),
+            tokenize=False,
+            add_generation_prompt=True
+        )
+        inputs = self.tokenizer(query, return_tensors="pt", add_special_tokens=False).to(self.model.device)
+        prompt_len = inputs["input_ids"].shape[1]
+        grammar = STRUCTURED_MESSAGE_GRAMMAR
+        with torch.no_grad():
+            output = self.model.generate(
+                **inputs,
+                logits_processor=LogitsProcessorList([GrammarLogitsProcessor(grammar, self.tokenizer, prompt_len, self.terminators)]),
+                stopping_criteria=StoppingCriteriaList([GrammarStoppingCriteria(grammar, self.tokenizer, prompt_len)]),
+                eos_token_id=self.terminators,
+                pad_token_id=self.tokenizer.pad_token_id,
+                **self._get_generate_kwargs(),
+            )
+        generated = output[0][prompt_len:]
+        text = self.tokenizer.decode(generated, skip_special_tokens=True)
+
+        # 生成上限のうち使わなかったトークン数を記録する(制約なしの場合と比べて削減できた数ではない)
+        max_new_tokens = self.generation_params["max_new_tokens"]
+        response = [{
+            "generated_text": query + text,
+            "generated_tokens": len(generated),
+            "unused_budget_tokens": max_new_tokens - len(generated),
+        }]
+        return text, response
+
+    # プロンプトを1回だけprefillし, そのKVキャッシュの上で各選択肢のトークンだけを評価して, 選択肢の対数尤度から分布を求める
+    def _score_choices_batch(self, prompts, choices, images):
+        queries = [
+            self.tokenizer.apply_chat_template(
+                self._prompt_format(prompt),
+                tokenize=False,
+                add_generation_prompt=True
+            ) for prompt in prompts
+        ]
+        query_ids = [self.tokenizer(query, add_special_tokens=False)["input_ids"] for query in queries]
+        choice_ids = [self.tokenizer(choice, add_special_tokens=False)["input_ids"] for choice in choices]
+        max_choice_len = max(len(ids) for ids in choice_ids)
+
+        scores = torch.zeros(len(queries), len(choices))
+        for q, ids in enumerate(query_ids):
+            with torch.no_grad():
+                prefill = self.model(
+                    input_ids=torch.tensor([ids], device=self.model.device),
+                    past_key_values=DynamicCache(),
+                    use_cache=True
+                )
+            # 選択肢の1トークン目はプロンプトの最後の位置の出力から求まる
+            first_log_probs = torch.log_softmax(prefill.logits[0, -1].float(), dim=-1)
+
+            # 2トークン目以降は, キャッシュを選択肢の数だけ複製して選択肢のトークン(最後を除く)だけを右側をパディングして入力する
+            rest_log_probs = None
+            if max_choice_len > 1:
+                cache = prefill.past_key_values
+                cache.batch_repeat_interleave(len(choices))
+                rest_len = max_choice_len - 1
+                input_ids = torch.full((len(choices), rest_len), self.tokenizer.pad_token_id)
+                attention_mask = torch.zeros((len(choices), len(ids) + rest_len), dtype=torch.long)
+                attention_mask[:, :len(ids)] = 1
+                for c, target in enumerate(choice_ids):
+                    input_ids[c, :len(target)-1] = torch.tensor(target[:-1], dtype=torch.long)
+                    attention_mask[c, len(ids):len(ids)+len(target)-1] = 1
+                position_ids = torch.arange(len(ids), len(ids) + rest_len)[None].expand(len(choices), -1)
+                with torch.no_grad():
+                    logits = self.model(
+                        input_ids=input_ids.to(self.model.device),
+                        attention_mask=attention_mask.to(self.model.device),
+                        position_ids=position_ids.to(self.model.device),
+                        past_key_values=cache
+                    ).logits.float()
+                rest_log_probs = torch.log_softmax(logits, dim=-1)
+
+            # 選択肢のトークンが出現する位置の対数確率を足し合わせる
+            for c, target in enumerate(choice_ids):
+                token_log_probs = [first_log_probs[target[0]]]
+                token_log_probs += [rest_log_probs[c, j-1, target[j]] for j in range(1, len(target))]
+                token_log_probs = torch.stack(token_log_probs)
+                if self.score_normalize == "mean":
+                    scores[q, c] = token_log_probs.mean()
+                else:
+                    scores[q, c] = token_log_probs.sum()
+
+        distributions = torch.softmax(scores, dim=-1)
+        return distributions.tolist()
+
+    # サンプリングせず順伝播のみを行い, 最終層の最後のトークンの隠れ状態を潜在表現とする
+    def _generate_internal_representation_batch(self, prompts):
+        queries = [
+            self.tokenizer.apply_chat_template(
+                self._prompt_format(prompt),
+                tokenize=False,
+                add_generation_prompt=True
+            ) for prompt in prompts
+        ]
+        inputs = self.tokenizer(
+            queries,
+            return_tensors="pt",
+            padding=True,
+            padding_side="left",
+            add_special_tokens=False
+        ).to(self.model.device)
+        # 左パディングでも各系列の位置が0から始まるようにする
+        position_ids = (inputs["attention_mask"].cumsum(-1) - 1).clamp(min=0)
+        with torch.no_grad():
+            output = self.model(
+                **inputs,
+                position_ids=position_ids,
+                output_hidden_states=True
+            )
+        hidden_states = output.hidden_states[-1][:, -1, :]
+        return list(hidden_states.float().cpu().numpy())
+
+class LlamaVision(LLM):
+    image_token = "<|image|>"
+    default_generation_params = {"max_new_tokens": 512}
+
+    def __init__(self, model_name, params:dict={}):
+        super().__init__(model_name, params)
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16
+        )
+        load = lambda: MllamaForConditionalGeneration.from_pretrained(
+            model_name,
+            quantization_config=quantization_config,
+            low_cpu_mem_usage=True,
+            use_safetensors=utils.get_value(params, "llm_use_safetensors", None),
+            device_map="auto"
+            #torch_dtype=torch.bfloat16,
+        )
+        self.model = ModelRegistry.get((model_name, "vision", utils.get_value(params, "llm_use_safetensors", None)), load)
+        self._load_tokenizer(model_name)
+        LLM.image_token = self.image_token
+
+    def _load_tokenizer(self, model_name):
+        self.processor = AutoProcessor.from_pretrained(model_name)
+
+    def _generate_text(self, prompt):
+        return "", {}
+    
+    def _generate_text_with_vision(self, prompt, image):
+        message = self._prompt_format(prompt)
+        input_text = self.processor.apply_chat_template(message, add_generation_prompt=True)
+        inputs = self.processor(image, input_text, return_tensors="pt").to(self.model.device)
+        response = self.model.generate(**inputs, **self._get_generate_kwargs())
+        text = self.processor.decode(response[0][1:-1])[len(input_text):]
+        return text, {"output":self.processor.decode(response[0][1:-1])}
+
+class Llava(LLM):
+    image_token = "<image>"
+    default_generation_params = {"max_new_tokens": 512}
+
+    def __init__(self, model_name, params:dict={}):
+        super().__init__(model_name, params)
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True, 
+            bnb_4bit_compute_dtype=torch.float16
+        )
+        load = lambda: LlavaNextForConditionalGeneration.from_pretrained(
+            model_name,
+            torch_dtype=torch.float16,
+            low_cpu_mem_usage=True,  # 消す?
+            use_safetensors=utils.get_value(params, "llm_use_safetensors", None),
+            quantization_config=quantization_config,
+        )
+        self.model = ModelRegistry.get((model_name, "vision", utils.get_value(params, "llm_use_safetensors", None)), load)
+        self._load_tokenizer(model_name)
+        LLM.image_token = self.image_token
+
+    def _load_tokenizer(self, model_name):
+        self.processor = LlavaNextProcessor.from_pretrained(model_name)
+
+    def _prompt_format(self, prompt):
+        #return f"[INST] {prompt} [/INST]"
+        return [
+            {"role": "user","content": [{"type": "text", "text": prompt},],},
+        ]
+
+    def _generate_text(self, prompt):
+        return "", {}
+    
+    def _generate_text_with_vision(self, prompt, image):
+        message = self._prompt_format(prompt)
+        input_text = self.processor.apply_chat_template(message, add_generation_prompt=True)
+        inputs = self.processor(input_text, image, return_tensors="pt").to(self.model.device)
+        response = self.model.generate(
+            **inputs,
+            **self._get_generate_kwargs()
+        )
+        text = self.processor.decode(response[0][1:-1])[len(input_text):]
+        return text, {"output":self.processor.decode(response[0])}
@@ -0,0 +1,102 @@
+import re
+import json
+import time
+import random
+import utils.utils as utils
+from utils.llm_utils import LLM
+
+# モデルを使わずに, 呼び出しの種類(phase)に応じたそれらしい応答を返すLLM
+# 応答の解析やサブゴール, 会話などの分岐も含めてmain.runを高速に回し, LLM以外のボトルネックを調べるために使う
+# "stub_script"で呼び出しの種類ごとの応答を指定すれば, その応答を順番に返す
+
+class Stub(LLM):
+    is_support_scoring = True
+
+    def __init__(self, model_name, params:dict={}):
+        super().__init__(model_name, params)
+        self.random = random.Random(utils.get_value(params, "stub_seed", 0))
+        self.latency = utils.get_value(params, "stub_latency", 0.0)
+        self.latency_per_token = utils.get_value(params, "stub_latency_per_token", 0.0)
+        self.yes_rate = utils.get_value(params, "stub_yes_rate", 0.3)
+        self.script: dict[str, list[str]] = utils.get_value(params, "stub_script", {})
+        self.script_indexes: dict[str, int] = {}
+
+    # 人工的な待ち時間(1回の呼び出しの固定分と, 生成したトークン数に比例する分)
+    def _wait(self, texts:list[str]):
+        delay = self.latency + self.latency_per_token * max([self._count_tokens(text) for text in texts], default=0)
+        if delay > 0:
+            time.sleep(delay)
+
+    # プロンプトの指示文(履歴の後ろの部分)にある引用符で囲まれた語句
+    def _get_quoted(self, prompt:str) -> list[str]:
+        instr = prompt.split("\n\n")[-1]
+        return re.findall(r"'([^']+)'", instr)
+
+    def _respond(self, prompt:str) -> str:
+        phase = self.phase
+        if phase in self.script and len(self.script[phase]) > 0:
+            index = self.script_indexes.get(phase, 0)
+            self.script_indexes[phase] = index + 1
+            return self.script[phase][index % len(self.script[phase])]
+
+        quoted = self._get_quoted(prompt)
+        if phase in ["action", "subgoal_to_action"]:
+            actions = [q for q in quoted if q not in ["Yes", "No"]]
+            return self.random.choice(actions) if len(actions) > 0 else "go to the forward coordinate"
+        elif phase == "subgoal":
+            return f"go to {quoted[0]}" if len(quoted) > 0 else "explore the room"
+        elif phase == "subgoal_judge":
+            return "Yes" if self.random.random() < self.yes_rate else "No"
+        elif phase == "subgoal_judge_all":
+            # 全サブゴールをまとめて判定するプロンプトにはYes/Noのリストを返す
+            subgoals = re.search(r"you should achieve (\[.*\])\. Was each subgoal achieved", prompt)
+            count = len(utils.text_to_str_list(subgoals.group(1))) if subgoals is not None else 1
+            return str(["Yes" if self.random.random() < self.yes_rate else "No" for _ in range(count)])
+        elif phase == "init_subgoal":
+            mission = re.search(r"Your mission is '([^']+)'", prompt)
+            mission = mission.group(1) if mission is not None else "complete the mission"
+            return str(["explore the room", "find the target object", mission])
+        elif phase == "consideration":
+            return "I should explore the room to find the target object, and avoid blocking my teammate."
+        elif phase == "consideration_action":
+            actions = [q for q in quoted if q not in ["Yes", "No"]]
+            return json.dumps({
+                "thought": "I should explore the room to find the target object, and avoid blocking my teammate.",
+                "action": self.random.choice(actions) if len(actions) > 0 else "go to the forward coordinate",
+            })
+        elif phase in ["message", "conversation"]:
+            return "I will search the left side of the room. Please search the right side."
+        elif phase == "structured_conversation":
+            return json.dumps({
+                "intent": self.random.choice(["PROPOSE", "INFORM", "REQUEST", "AGREE", "REJECT"]),
+                "target_object": None,
+                "target_coordinate": [self.random.randint(0, 9), self.random.randint(0, 9)],
+                "action_plan": "search the left side of the room",
+                "message": "I will search the left side of the room.",
+            })
+        elif phase == "reflexion":
+            return "I should share what I see with my teammate earlier and split up the search."
+        return "I don't know."
+
+    def _generate_text(self, prompt):
+        return self._generate_text_batch([prompt], [None])[0]
+
+    def _generate_text_with_vision(self, prompt, image):
+        return self._generate_text_batch([prompt], [image])[0]
+
+    # まとめて呼び出した場合は待ち時間も1回分とする(バッチ推論の想定)
+    def _generate_text_batch(self, prompts, images):
+        texts = [self._respond(prompt) for prompt in prompts]
+        self._wait(texts)
+        return [(text, {"phase": self.phase}) for text in texts]
+
+    def _generate_structured(self, prompt, image):
+        return self._generate_text(prompt)
+
+    def _score_choices_batch(self, prompts, choices, images):
+        self._wait([])
+        distributions = []
+        for _ in prompts:
+            weights = [self.random.random() for _ in choices]
+            distributions.append([weight / sum(weights) for weight in weights])
+        return distributions
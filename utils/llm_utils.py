@@ -1,74 +1,134 @@
-import os
+import time
+import types
+import threading
+import importlib
+from contextlib import contextmanager
 import utils.utils as utils
-
-from openai import OpenAI
-import tiktoken
-
-import transformers
-from transformers import (
-    AutoModelForSeq2SeqLM,
-    AutoModelForCausalLM,
-    AutoTokenizer,
-    BitsAndBytesConfig,
-    T5Tokenizer,
-    MllamaForConditionalGeneration,
-    LlavaNextForConditionalGeneration,
-    AutoProcessor,
-    LlavaNextProcessor
-)
+from utils.cache_utils import ResponseCache
+from utils.representation_utils import RepresentationStore
+from utils.usage_utils import UsageRecorder, TimingStreamer
+from utils.router_utils import Router
+from utils.registry_utils import ModelRegistry, load_timer
 
 import numpy as np
-import torch
-import ENV
 
 # LLMに関する(比較的)Lowレベルな設定を行う
 # "プロンプトを投げたら出力文が返ってくる" を実現するためのクラス
 # この実験以外でもLLMを手軽に使えるかも
 
+SERVER_PREFIX = "server:"
+
+# バックエンド名と, それを定義するモジュールとクラス名の対応
+# torchやtransformers, openaiなどの重いライブラリは使用するバックエンドの分だけ遅延してimportする
+BACKENDS = {
+    "llama": ("utils.llm_backends.llama", "Llama"),
+    "llama_vision": ("utils.llm_backends.llama", "LlamaVision"),
+    "llava": ("utils.llm_backends.llama", "Llava"),
+    "gpt": ("utils.llm_backends.gpt", "Gpt"),
+    "server": ("utils.llm_backends.gpt", "LocalServer"),
+    "flan": ("utils.llm_backends.flan", "Flan"),
+    "stub": ("utils.llm_backends.stub", "Stub"),
+}
+
 # 初期化とテキスト生成の機能を持ったLLM
 class LLM:
 
     __llm = None
     __llm_high = None
+    __cache = ResponseCache()
+    __usage = UsageRecorder()
+    __router = Router()
+    __profiles: dict[str, dict] = {}
+    # 呼び出し中のTicket(ルーティングによる呼び出しは別スレッドで行われることがあるので, スレッドごとに保持する)
+    __local = threading.local()
 
     image_token:str = ""
+    default_generation_params:dict = {}
+    is_support_scoring:bool = False
 
-    # モデル名から各インスタンスを生成
+    # モデル名からバックエンド名を取得
     @staticmethod
-    def __make(model_name) -> 'LLM':
-        if "llama" in model_name:
+    def get_backend_name(model_name) -> str:
+        if model_name.startswith(SERVER_PREFIX):
+            return "server"
+        elif model_name.startswith("stub"):
+            return "stub"
+        elif "llama" in model_name:
             if "llava" in model_name:
-                llm_instance = Llava(model_name)
+                return "llava"
             elif "Vision" in model_name:
-                llm_instance = LlamaVision(model_name)            
+                return "llama_vision"
             else:
-                llm_instance = Llama(model_name)
+                return "llama"
         elif "gpt" in model_name:
-            llm_instance = Gpt(model_name)
+            return "gpt"
         elif "flan" in model_name:
-            llm_instance = Flan(model_name)
-        else:
-            llm_instance = LLM("free")
-        return llm_instance
+            return "flan"
+        return "free"
+
+    # モデル名から対応するクラスを取得(選択されたバックエンドの依存ライブラリだけをここで初めて読み込む)
+    @staticmethod
+    def get_backend_class(model_name) -> type:
+        backend_name = LLM.get_backend_name(model_name)
+        if backend_name not in BACKENDS:
+            return LLM
+        module_name, class_name = BACKENDS[backend_name]
+        return getattr(importlib.import_module(module_name), class_name)
+
+    # モデル名から各インスタンスを生成
+    @classmethod
+    def __make(cls, model_name, params:dict) -> 'LLM':
+        llm_class = cls.get_backend_class(model_name)
+        if llm_class is LLM:
+            return LLM("free", params)
+        if cls.__cache.is_replay():
+            # replayモードではモデルを読み込まず, キャッシュのキーに必要な情報だけを持たせる
+            llm_instance = LLM(model_name, params)
+            llm_instance.generation_params = llm_class._get_generation_params(params)
+            llm_instance.is_support_scoring = llm_class.is_support_scoring
+            llm_instance.backend_class = llm_class
+            # 履歴をトークン数の上限に合わせて削る場合に記録時と同じプロンプトになるよう, トークナイザだけは読み込む
+            llm_instance._count_tokens = types.MethodType(llm_class._count_tokens, llm_instance)
+            llm_class._load_tokenizer(llm_instance, model_name)
+            LLM.image_token = llm_class.image_token
+            return llm_instance
+        with load_timer(f"load {model_name}"):
+            return llm_class(model_name, params)
     
+    # バックエンドのインスタンスを直接生成する(推論サーバなどから使う場合)
+    @classmethod
+    def create(cls, model_name, params:dict={}) -> 'LLM':
+        return cls.__make(model_name, params)
+
     # モデルの読み込み
     @classmethod
     def load(cls, params):
         is_free_mode = utils.get_value(params, "free_mode", False)
+        cls.__cache = ResponseCache(params)
+        cls.__profiles = utils.get_value(params, "generation_profiles", {})
+        ModelRegistry.configure(params)
 
         # 通常のモデルを読み込み
+        # configごとの設定(バッチサイズや接頭辞キャッシュなど)を反映するため, インスタンスは毎回作り直す(重みはModelRegistryで使い回す)
         model_name = params["llm_model"] if not is_free_mode else "free"
-        if cls.__llm is None or model_name != cls.__llm.model_name:
-            cls.__llm = cls.__make(model_name)
+        cls.__llm = cls.__make(model_name, params)
 
         # よりハイレベルなモデル(通常はGPTを想定)を読み込み
         high_model_name = utils.get_value(params, "llm_high_model", "none")
-        if high_model_name == "none":
+        high_model_name = high_model_name if not is_free_mode or high_model_name == "none" else "free"
+        if high_model_name == "none" or high_model_name == model_name:
             cls.__llm_high = cls.__llm
         else:
-            high_model_name = high_model_name if not is_free_mode else "free"
-            if cls.__llm_high is None or high_model_name != cls.__llm_high.model_name:
-                cls.__llm_high = cls.__make(high_model_name)
+            cls.__llm_high = cls.__make(high_model_name, params)
+
+        # 呼び出しの種類ごとのモデルの割り当て(このconfigで読み込んだモデルは使い回す)
+        def get_llm(name:str) -> 'LLM':
+            name = name if not is_free_mode else "free"
+            for llm in [cls.__llm, cls.__llm_high]:
+                if llm.model_name == name:
+                    return llm
+            return cls.__make(name, params)
+        cls.__router.load(params, get_llm)
 
     @staticmethod
     def __generate(llm:'LLM', prompt:str, image):
@@ -76,30 +136,270 @@ class LLM:
             return llm._generate_text_with_vision(prompt, image)
         return llm._generate_text(prompt)
 
+    # キャッシュを確認し, 見つからなかった入力だけをまとめてfuncに渡す
+    # 各入力のトークン数と所要時間は呼び出しの種類(phase)とエージェントIDをつけて記録する
+    @classmethod
+    def __cached_call(cls, llm:'LLM', prompts:list[str], images:list, key_params:dict, func, phase:str, agent_ids:list) -> list[tuple]:
+        if agent_ids is None:
+            agent_ids = [None] * len(prompts)
+        keys = None
+        outputs = [None] * len(prompts)
+        if cls.__cache.is_enabled():
+            keys = [cls.__cache.make_key(llm.model_name, key_params, prompt, image) for prompt, image in zip(prompts, images)]
+            outputs = [cls.__cache.get(key) for key in keys]
+        missed = [i for i, output in enumerate(outputs) if output is None]
+
+        llm.timing = {}
+        llm.phase = phase
+        elapsed = 0.0
+        if len(missed) > 0:
+            start = time.perf_counter()
+            generated = func([prompts[i] for i in missed], [images[i] for i in missed])
+            elapsed = time.perf_counter() - start
+            # 時間切れで見捨てられた呼び出しの結果はキャッシュにも使用量にも残さない
+            ticket = getattr(cls.__local, "ticket", None)
+            if ticket is not None and not ticket.commit():
+                return outputs
+            for i, (text, response) in zip(missed, generated):
+                if keys is not None:
+                    cls.__cache.set(keys[i], text, response)
+                outputs[i] = (text, response)
+        cls.__usage.record_batch(llm, phase, agent_ids, prompts, outputs, missed, elapsed)
+        return outputs
+
+    # 呼び出しの種類に応じた生成設定を取得("default"の設定を上書きする)
+    @classmethod
+    def __get_profile(cls, phase:str) -> dict:
+        default = utils.get_value(cls.__profiles, "default", {})
+        return {**default, **utils.get_value(cls.__profiles, phase, {})}
+
+    @classmethod
+    def __generate_batch(cls, llm:'LLM', prompts:list[str], images:list, phase:str, agent_ids:list = None, profile:dict = None) -> list[tuple]:
+        if images is None:
+            images = [None] * len(prompts)
+        assert len(prompts) == len(images)
+        if len(prompts) == 0: return []
+
+        profile = {**cls.__get_profile(phase), **(profile or {})}
+        def generate(prompts, images):
+            outputs = llm._generate_text_batch(prompts, images)
+            return [(LLM._truncate_at_stop(text, profile), response) for text, response in outputs]
+
+        with llm.use_profile(profile):
+            return cls.__cached_call(llm, prompts, images, llm.generation_params, generate, phase, agent_ids)
+
+    # 呼び出しの種類に割り当てられたモデル(割り当てがなければdefault_llm)でcall(llm)を実行する
+    # どのモデルが応答したか(primary/fallback)は使用量の記録に残す
+    @classmethod
+    def __route(cls, phase:str, default_llm:'LLM', call):
+        def routed_call(llm:'LLM', role:str, ticket):
+            cls.__usage.set_route(role)
+            cls.__local.ticket = ticket
+            try:
+                return call(llm)
+            finally:
+                cls.__usage.set_route("")
+                cls.__local.ticket = None
+        return cls.__router.call(phase, default_llm, routed_call)
+
     # 出力
     @classmethod
-    def generate(cls, prompt:str, image = None) -> str:
-        return cls.__generate(cls.__llm, prompt, image)
+    def generate(cls, prompt:str, image = None, phase:str = "default", agent_id:int = None) -> str:
+        return cls.generate_batch([prompt], [image], phase, [agent_id])[0]
 
     # 高位のモデルで出力
     @classmethod
-    def generate_high(cls, prompt:str, image = None) -> str:
-        return cls.__generate(cls.__llm_high, prompt, image)
+    def generate_high(cls, prompt:str, image = None, phase:str = "default", agent_id:int = None) -> str:
+        call = lambda llm: cls.__generate_batch(llm, [prompt], [image], phase, [agent_id])
+        return cls.__route(phase, cls.__llm_high, call)[0]
+
+    # 複数のプロンプトをまとめて出力(エージェント毎の呼び出しを1回にまとめる)
+    # profileを渡すと呼び出しの種類の生成設定をさらに上書きする(入力に応じて生成上限を変える場合など)
+    @classmethod
+    def generate_batch(cls, prompts:list[str], images:list = None, phase:str = "default", agent_ids:list = None, profile:dict = None) -> list[tuple]:
+        call = lambda llm: cls.__generate_batch(llm, prompts, images, phase, agent_ids, profile)
+        return cls.__route(phase, cls.__llm, call)
+
+    # 応答を少しずつ受け取り, is_done(これまでの応答)が真になった時点で生成を打ち切る
+    # キャッシュのキーにはis_doneの関数名を含めるので, 判定の異なる関数には別の名前をつけること
+    @classmethod
+    def generate_until(cls, prompt:str, image = None, phase:str = "default", agent_id:int = None, is_done = None) -> tuple:
+        call = lambda llm: cls.__generate_until(llm, prompt, image, phase, agent_id, is_done)
+        return cls.__route(phase, cls.__llm, call)
+
+    @classmethod
+    def __generate_until(cls, llm:'LLM', prompt:str, image, phase:str, agent_id:int, is_done) -> tuple:
+        profile = cls.__get_profile(phase)
+        def generate(prompts, images):
+            outputs = []
+            for prompt, image in zip(prompts, images):
+                text = ""
+                is_cancelled = False
+                stream = llm._generate_text_stream(prompt, image)
+                try:
+                    for chunk in stream:
+                        text += chunk
+                        if is_done is not None and is_done(text):
+                            is_cancelled = True
+                            break
+                finally:
+                    stream.close()
+                outputs.append((LLM._truncate_at_stop(text, profile), {"streamed": True, "cancelled": is_cancelled}))
+            return outputs
+        with llm.use_profile(profile):
+            key_params = {**llm.generation_params, "until": getattr(is_done, "__name__", None)}
+            return cls.__cached_call(llm, [prompt], [image], key_params, generate, phase, [agent_id])[0]
+
+    # 構造化通信のJSONスキーマに沿った応答を生成する(対応していないバックエンドでは通常の生成)
+    @classmethod
+    def generate_structured(cls, prompt:str, image = None, phase:str = "default", agent_id:int = None) -> tuple:
+        call = lambda llm: cls.__generate_structured(llm, prompt, image, phase, agent_id)
+        return cls.__route(phase, cls.__llm, call)
+
+    @classmethod
+    def __generate_structured(cls, llm:'LLM', prompt:str, image, phase:str, agent_id:int) -> tuple:
+        def generate(prompts, images):
+            return [llm._generate_structured(prompt, image) for prompt, image in zip(prompts, images)]
+        with llm.use_profile(cls.__get_profile(phase)):
+            key_params = {**llm.generation_params, "grammar": "structured_message"}
+            return cls.__cached_call(llm, [prompt], [image], key_params, generate, phase, [agent_id])[0]
+
+    # 各選択肢の尤度を求め, 選択肢上の確率分布を返す
+    @classmethod
+    def score_batch(cls, prompts:list[str], choices:list[str], images:list = None, phase:str = "default", agent_ids:list = None) -> list[list[float]]:
+        if images is None:
+            images = [None] * len(prompts)
+        if len(prompts) == 0: return []
+        call = lambda llm: cls.__score_batch(llm, prompts, choices, images, phase, agent_ids)
+        return cls.__route(phase, cls.__llm, call)
+
+    @classmethod
+    def __score_batch(cls, llm:'LLM', prompts:list[str], choices:list[str], images:list, phase:str, agent_ids:list) -> list[list[float]]:
+        profile = cls.__get_profile(phase)
+
+        def score(prompts, images):
+            if llm.is_support_scoring:
+                distributions = llm._score_choices_batch(prompts, choices, images)
+            else:
+                # 尤度を計算できないバックエンドは生成した文と選択肢を照合する
+                outputs = llm._generate_text_batch(prompts, images)
+                distributions = [LLM._text_to_distribution(LLM._truncate_at_stop(text, profile), choices) for text, _ in outputs]
+            return [(choices[int(np.argmax(distribution))], distribution) for distribution in distributions]
+
+        with llm.use_profile(profile):
+            key_params = {**llm.generation_params, "score_choices": choices}
+            outputs = cls.__cached_call(llm, prompts, images, key_params, score, phase, agent_ids)
+        return [distribution for _, distribution in outputs]
+
+    # 通常のモデルのトークナイザでトークン数を数える
+    @classmethod
+    def count_tokens(cls, text:str) -> int:
+        cls.__router.wait(cls.__llm)
+        return cls.__llm._count_tokens(text)
+
+    # LLMの呼び出しごとのトークン数と所要時間の記録
+    @classmethod
+    def get_usage(cls) -> UsageRecorder:
+        return cls.__usage
+
+    # 停止文字列が現れたらその直後で打ち切る(バックエンドによる停止位置の違いをそろえる)
+    @staticmethod
+    def _truncate_at_stop(text:str, profile:dict) -> str:
+        stops = utils.get_value(profile, "stop", [])
+        positions = [text.find(stop) + len(stop) for stop in stops if stop in text]
+        if len(positions) == 0: return text
+        return text[:min(positions)]
+
+    # 生成文に最初に現れる選択肢を選ぶ(見つからなければ一様分布)
+    @staticmethod
+    def _text_to_distribution(text:str, choices:list[str]) -> list[float]:
+        text = text.lower()
+        positions = [text.find(choice.lower()) for choice in choices]
+        found = [(position, i) for i, position in enumerate(positions) if position >= 0]
+        if len(found) == 0:
+            return [1 / len(choices)] * len(choices)
+        distribution = [0.0] * len(choices)
+        distribution[min(found)[1]] = 1.0
+        return distribution
 
     # 潜在表現を取得
     @classmethod
     def get_internal_representation(cls, text:str):
-        return cls.__llm._generate_internal_representation(text)
+        cls.__router.wait(cls.__llm)
+        return cls.__llm._get_internal_representations([text])[0]
+
+    # 複数のテキストの潜在表現をまとめて取得
+    @classmethod
+    def get_internal_representations(cls, texts:list[str]) -> list:
+        cls.__router.wait(cls.__llm)
+        return cls.__llm._get_internal_representations(texts)
 
     # テキスト同士の類似度を取得する
     @classmethod
     def get_similarity(cls, text1:str, text2:str) -> float:
+        cls.__router.wait(cls.__llm)
         return cls.__llm._get_similarity(text1, text2)
 
     # LLMの初期化処理
-    def __init__(self, model_name):
+    def __init__(self, model_name, params:dict={}):
         self.model_name = model_name
-        self.internal_representations = {}
+        self.representations = RepresentationStore(model_name, params)
+        self.batch_size = utils.get_value(params, "llm_batch_size", 8)
+        self.generation_params = self._get_generation_params(params)
+        self.backend_class = type(self)
+        self.timing = {}
+        self.phase = "default"
+
+    # configから既定の生成設定を作る(replayモードでもキャッシュのキーを記録時と揃えるため, モデルを読み込まずに求められるようにする)
+    @classmethod
+    def _get_generation_params(cls, params:dict) -> dict:
+        return dict(cls.default_generation_params)
+
+    # 生成設定(max_new_tokens, temperature, top_p, stop)を既定の設定に反映する
+    @classmethod
+    def _apply_profile(cls, generation_params:dict, profile:dict) -> dict:
+        params = dict(generation_params)
+        for key in ["max_new_tokens", "temperature", "top_p"]:
+            if key in profile:
+                params[key] = profile[key]
+        if "stop" in profile:
+            params["stop_strings"] = profile["stop"]
+        # 温度0は貪欲法として扱う
+        if "temperature" in params and params["temperature"] == 0:
+            params["do_sample"] = False
+            params.pop("temperature")
+            params.pop("top_p", None)
+        return params
+
+    # 生成設定を一時的に切り替える
+    @contextmanager
+    def use_profile(self, profile:dict):
+        default = self.generation_params
+        self.generation_params = self.backend_class._apply_profile(default, profile)
+        try:
+            yield
+        finally:
+            self.generation_params = default
+
+    # model.generateに渡す引数(停止文字列の判定にはトークナイザが必要)
+    def _get_generate_kwargs(self) -> dict:
+        kwargs = dict(self.generation_params)
+        kwargs["streamer"] = TimingStreamer(self.timing)
+        if "stop_strings" in kwargs:
+            kwargs["tokenizer"] = self.tokenizer if hasattr(self, "tokenizer") else self.processor.tokenizer
+        return kwargs
+
+    # トークン数を数えるためのトークナイザを読み込む(replayモードではモデルの代わりにこれだけを読み込む)
+    def _load_tokenizer(self, model_name):
+        pass
+
+    # トークン数を数える(トークナイザを持たないバックエンドでは単語数で近似する)
+    def _count_tokens(self, text:str) -> int:
+        if hasattr(self, "tokenizer"):
+            return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+        if hasattr(self, "processor"):
+            return len(self.processor.tokenizer(text, add_special_tokens=False)["input_ids"])
+        return len(text.split())
 
     # プロンプトをChat形式に変換
     def _prompt_format(self, prompt):
@@ -116,251 +416,39 @@ class LLM:
     # プロンプトと画像をもとに応答を生成
     def _generate_text_with_vision(self, prompt, image):
         return self._generate_text(prompt)
+
+    # 複数のプロンプトをもとに応答をまとめて生成(バックエンドが対応していなければ逐次実行)
+    def _generate_text_batch(self, prompts:list[str], images:list) -> list[tuple]:
+        return [LLM.__generate(self, prompt, image) for prompt, image in zip(prompts, images)]
     
-    # 入力の潜在表現を取得
-    def _generate_internal_representation(self, prompt):
-        return np.array([0])
+    # 応答を少しずつ返す(対応していないバックエンドでは応答全体を1度に返す)
+    def _generate_text_stream(self, prompt, image):
+        yield LLM.__generate(self, prompt, image)[0]
+
+    # スキーマに沿った応答を生成
+    def _generate_structured(self, prompt, image):
+        return LLM.__generate(self, prompt, image)
+
+    # 各プロンプトについて選択肢の確率分布を求める
+    def _score_choices_batch(self, prompts:list[str], choices:list[str], images:list) -> list[list[float]]:
+        return [[1 / len(choices)] * len(choices) for _ in prompts]
+
+    # キャッシュにない入力だけをまとめて順伝播し, 潜在表現を取得
+    def _get_internal_representations(self, prompts:list[str]) -> list:
+        vectors = [self.representations.get(prompt) for prompt in prompts]
+        missing = list(dict.fromkeys(prompt for prompt, vector in zip(prompts, vectors) if vector is None))
+        computed = {}
+        for start in range(0, len(missing), self.batch_size):
+            chunk = missing[start:start+self.batch_size]
+            results = self._generate_internal_representation_batch(chunk)
+            self.representations.set_batch(chunk, results)
+            computed.update(zip(chunk, results))
+        return [computed[prompt] if vector is None else vector for prompt, vector in zip(prompts, vectors)]
+
+    # 入力の潜在表現をまとめて求める
+    def _generate_internal_representation_batch(self, prompts:list[str]) -> list:
+        return [np.array([0], dtype=np.float32) for _ in prompts]
     
     def _get_similarity(self, text1, text2) -> float:
-        v1 = self._generate_internal_representation(text1)
-        v2 = self._generate_internal_representation(text2)
+        v1, v2 = self._get_internal_representations([text1, text2])
         return utils.get_cos_similarity(v1, v2)
-
-class Llama(LLM):
-    def __init__(self, model_name):
-        super().__init__(model_name)
-
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        
-        # 環境に応じて読み込み設定を切り替える
-        if torch.cuda.is_available():
-            quantization_config = BitsAndBytesConfig(
-                load_in_4bit=True,
-                bnb_4bit_use_double_quant=True,
-                bnb_4bit_quant_type="nf4",
-                bnb_4bit_compute_dtype=torch.bfloat16
-            )
-
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_name,
-                quantization_config=quantization_config,
-                cache_dir=ENV.model_dir,
-                low_cpu_mem_usage=True
-            )
-        else:
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_name,
-                torch_dtype=torch.bfloat16,
-                cache_dir=ENV.model_dir,
-                low_cpu_mem_usage=True,
-                device_map="auto"
-            )
-
-        self.pipeline = transformers.pipeline(
-            "text-generation",
-            model=self.model,
-            tokenizer=self.tokenizer,
-            model_kwargs={"torch_dtype": torch.bfloat16},
-        )
-        self.terminators = [
-            self.pipeline.tokenizer.eos_token_id,
-            self.pipeline.tokenizer.convert_tokens_to_ids("<|eot_id|>")
-        ]
-    
-    def _generate_text(self, prompt):
-        message = self._prompt_format(prompt)
-        query = self.pipeline.tokenizer.apply_chat_template(
-            message,
-            tokenize=False,
-            add_generation_prompt=True
-        )
-        response = self.pipeline(
-            query,
-            max_new_tokens=256,
-            eos_token_id=self.terminators,
-            pad_token_id=self.pipeline.tokenizer.eos_token_id,
-            do_sample=True,
-            temperature=0.6,
-            top_p=0.9,
-        )
-        text = response[0]["generated_text"][len(query):]
-        text = response[0]["generated_text"][len(query):]
-        return text, response
-    
-    def _generate_internal_representation(self, prompt):
-        if prompt in self.internal_representations.keys():
-            return self.internal_representations[prompt]
-        message = self._prompt_format(prompt)
-        query = self.pipeline.tokenizer.apply_chat_template(
-            message,
-            tokenize=False,
-            add_generation_prompt=True
-        )
-        inputs = self.tokenizer(query, return_tensors="pt")["input_ids"].to("cuda")
-        eos_token_id = self.tokenizer.eos_token_id
-        output = self.model.generate(
-            input_ids=inputs,
-            do_sample=True,
-            temperature=0.6, # 0.6
-            top_p=0.9, # 0.9
-            max_new_tokens=1,
-            eos_token_id=eos_token_id,
-            pad_token_id=eos_token_id,
-            return_dict_in_generate=True,
-            output_logits=True,
-            output_hidden_states=True,
-        )
-        result_tensor = output.hidden_states[0][-1][0][-1]
-        internal_representation = result_tensor.to('cpu').detach().numpy().copy()
-        self.internal_representations[prompt] = internal_representation
-        return internal_representation
-
-class LlamaVision(LLM):
-    def __init__(self, model_name):
-        super().__init__(model_name)
-        quantization_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.bfloat16
-        )
-        self.model = MllamaForConditionalGeneration.from_pretrained(
-            model_name,
-            quantization_config=quantization_config,
-            low_cpu_mem_usage=True,
-            device_map="auto"
-            #torch_dtype=torch.bfloat16,
-        )
-        self.processor = AutoProcessor.from_pretrained(model_name)
-        LLM.image_token = "<|image|>"
-
-    def _generate_text(self, prompt):
-        return "", {}
-    
-    def _generate_text_with_vision(self, prompt, image):
-        message = self._prompt_format(prompt)
-        input_text = self.processor.apply_chat_template(message, add_generation_prompt=True)
-        inputs = self.processor(image, input_text, return_tensors="pt").to(self.model.device)
-        response = self.model.generate(**inputs, max_new_tokens=512)
-        text = self.processor.decode(response[0][1:-1])[len(input_text):]
-        return text, {"output":self.processor.decode(response[0][1:-1])}
-
-class Llava(LLM):
-    def __init__(self, model_name):
-        super().__init__(model_name)
-        quantization_config = BitsAndBytesConfig(
-            load_in_4bit=True, 
-            bnb_4bit_compute_dtype=torch.float16
-        )
-        self.model = LlavaNextForConditionalGeneration.from_pretrained(
-            model_name,
-            torch_dtype=torch.float16,
-            low_cpu_mem_usage=True,  # 消す?
-            quantization_config=quantization_config,
-        )
-        self.processor = LlavaNextProcessor.from_pretrained(model_name)
-        LLM.image_token = "<image>"
-
-    def _prompt_format(self, prompt):
-        #return f"[INST] {prompt} [/INST]"
-        return [
-            {"role": "user","content": [{"type": "text", "text": prompt},],},
-        ]
-
-    def _generate_text(self, prompt):
-        return "", {}
-    
-    def _generate_text_with_vision(self, prompt, image):
-        message = self._prompt_format(prompt)
-        input_text = self.processor.apply_chat_template(message, add_generation_prompt=True)
-        inputs = self.processor(input_text, image, return_tensors="pt").to(self.model.device)
-        response = self.model.generate(
-            **inputs,
-            max_new_tokens=512
-        )
-        text = self.processor.decode(response[0][1:-1])[len(input_text):]
-        return text, {"output":self.processor.decode(response[0])}
-
-class Gpt(LLM):
-    def __init__(self, model_name):
-        super().__init__(model_name)
-        self.client = OpenAI(api_key = ENV.openai_api_key)
-        self.encoding = tiktoken.encoding_for_model(model_name)
-        self.input_token = 0
-        self.output_token = 0
-    
-    def _prompt_format(self, prompt, image = None):
-        if image is None: return super()._prompt_format(prompt)
-
-        image_base64 = utils.np_image_to_base64(image)
-        return [{
-            "role": "user",
-            "content": [
-                {"type": "text", "text": prompt},
-                {"type": "image_url", "image_url": {"url":  f"data:image/jpeg;base64,{image_base64}"}}
-            ]
-        }]
-
-    def _call_api(self, prompt, image = None):
-        messages = self._prompt_format(prompt, image)
-        response = self.client.chat.completions.create(
-            model = self.model_name,
-            messages = messages
-        )
-        text = response.choices[0].message.content
-
-        return text, {}
-
-    def _generate_text(self, prompt):
-        return self._call_api(prompt)
-
-    def _generate_text_with_vision(self, prompt, image):
-        return self._call_api(prompt, image)
-
-class Flan(LLM):
-    def __init__(self, model_name):
-        super().__init__(model_name)
-        hyperparams = {
-            "model_name": model_name,
-            "env": "Blackjack-v1",
-            "load_in_8bit": True,
-            "batch_size": 8,
-            "seed": 42069,
-            "episodes": 5000,
-            "generate/max_new_tokens": 32,
-            "generate/do_sample": True,
-            "generate/top_p": 0.6,
-            "generate/top_k": 0,
-            "generate/temperature": 0.9,
-        }
-        device = "cuda"
-        HF_TOKEN = os.environ.get("HF_TOKEN")
-
-        self.model = AutoModelForSeq2SeqLM.from_pretrained(
-            pretrained_model_name_or_path=hyperparams["model_name"],
-            load_in_8bit=hyperparams["load_in_8bit"],
-            token=HF_TOKEN,
-        ).to(device)
-
-        self.tokenizer = T5Tokenizer.from_pretrained(model_name, device_map=device, token=HF_TOKEN)
-        self.tokenizer.add_special_tokens({"pad_token": "<pad>"})
-        self.model.pretrained_model.resize_token_embeddings(len(self.tokenizer))
-
-    def _generate_text(self, prompt):
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
-        output = self.model.generate(
-            inputs=inputs.input_ids,
-            return_dict_in_generate=True,
-            output_logits=True,
-            **{
-                key.split("/")[-1]: value
-                for key, value in self.generate_config_dict.items()
-            }
-        )
-        generate_ids = output.sequences
-        response = self.tokenizer.batch_decode(
-            generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        )
-        text = response[0].split("[/INST]")[-1].strip()
-
-        return text, response
\ No newline at end of file
@@ -6,6 +6,7 @@ import utils.utils as utils
 from utils.embedding_utils import Embedder
 import json
 import re
+import numpy as np
 
 # 方策に関する細かい処理
 # policy.pyから呼び出される
@@ -20,12 +21,24 @@ def act_by_llm(env:gym.Env, reflexion:Reflexion, pre_info:dict, params:dict={})
 
     imgs = env_utils.get_imgs(env, params)
 
-    # 各エージェントが行動を決定する
+    # 各エージェントが行動を決定する(全エージェント分をまとめて生成)
+    prompts = [reflexion.get_action_prompt(agent_id, params) for agent_id in range(env.agent_num)]
+    action_mode = utils.get_value(params, "action_mode", "generate")
+    if action_mode == "score":
+        # 生成せずに各行動の尤度を比較して選ぶ
+        actions_str = env_utils.get_actions_str(params["env_name"])
+        distributions = LLM.score_batch(prompts, actions_str, imgs, "action", list(range(env.agent_num)))
+        outputs = [(actions_str[int(np.argmax(d))], {"distribution": d}) for d in distributions]
+    elif action_mode == "stream":
+        # 応答を少しずつ受け取り, 行動名が1つに定まった時点で生成を打ち切る(エージェントごとに逐次実行)
+        def is_action_found(text:str) -> bool:
+            return env_utils.find_action(text, params) is not None
+        outputs = [LLM.generate_until(prompts[agent_id], imgs[agent_id], "action", agent_id, is_action_found) for agent_id in range(env.agent_num)]
+    else:
+        outputs = LLM.generate_batch(prompts, imgs, "action", list(range(env.agent_num)))
+
     actions = []
-    for agent_id in range(env.agent_num):
-        # 履歴をもとに状態(文字列)を生成
-        prompt = reflexion.get_action_prompt(agent_id, params)
-        action_str, response = LLM.generate(prompt, imgs[agent_id])
+    for prompt, (action_str, response) in zip(prompts, outputs):
         action = env_utils.str_to_action(action_str, params)
         actions.append(action)
 
@@ -97,7 +110,7 @@ def act_by_hierarchical_subgoal(env:gym.Env, reflexion:Reflexion, pre_info:dict,
         if subgoal_tree.is_after_halfway_node() or True:
             for _ in range(len(subgoals), subgoal_max_generation):
                 prompt = reflexion.get_subgoal_prompt(agent_id, achieved_subgoals, subgoals, params)
-                subgoal, _ = LLM.generate(prompt, imgs[agent_id])
+                subgoal, _ = LLM.generate(prompt, imgs[agent_id], "subgoal", agent_id)
                 subgoal = subgoal_format(subgoal)
                 info["queries"].append(prompt)
                 info["responses"].append(subgoal)
@@ -120,7 +133,7 @@ def act_by_hierarchical_subgoal(env:gym.Env, reflexion:Reflexion, pre_info:dict,
         # サブゴールを行動に変換する
         if not is_subgoal_atomic:
             prompt = reflexion.get_subgoal_to_action_prompt(agent_id, subgoals, params)
-            subgoal, _ = LLM.generate(prompt, imgs[agent_id])
+            subgoal, _ = LLM.generate(prompt, imgs[agent_id], "subgoal_to_action", agent_id)
             info["queries"].append(prompt)
             info["responses"].append(subgoal)
             action, _ = get_max_similarity(subgoal, actions_str)
@@ -154,11 +167,11 @@ def consideration(env:gym.Env, reflexion:Reflexion, pre_info:dict, params:dict={
 
     imgs = env_utils.get_imgs(env, params)
 
-    # 各エージェントが状況について考える
-    for agent_id in range(env.agent_num):
-        # 履歴をもとに状態(文字列)を生成
-        prompt = reflexion.get_consideration_prompt(agent_id, params)
-        text, response = LLM.generate(prompt, imgs[agent_id])
+    # 各エージェントが状況について考える(全エージェント分をまとめて生成)
+    prompts = [reflexion.get_consideration_prompt(agent_id, params) for agent_id in range(env.agent_num)]
+    outputs = LLM.generate_batch(prompts, imgs, "consideration", list(range(env.agent_num)))
+
+    for prompt, (text, response) in zip(prompts, outputs):
         text = "You think:" + text
 
         info["queries"].append(prompt)
@@ -170,6 +183,48 @@ def consideration(env:gym.Env, reflexion:Reflexion, pre_info:dict, params:dict={
 
     utils.dict_of_lists_extend(pre_info, info)
 
+# LLMで状況についての思考と行動を1回の呼び出しでまとめて決定する
+# consideration()とact_by_llm()を続けて呼ぶ場合と同じラベルで履歴に追加し, 同じ形式でログを残す
+def consider_and_act_by_llm(env:gym.Env, reflexion:Reflexion, pre_info:dict, params:dict={}) -> list[int]:
+    info = {
+        "queries":[],
+        "responses":[],
+        "considerations":[],
+        "actions":[],
+    }
+
+    imgs = env_utils.get_imgs(env, params)
+
+    # 各エージェントが思考と行動をJSONで出力する(全エージェント分をまとめて生成)
+    prompts = [reflexion.get_consideration_action_prompt(agent_id, params) for agent_id in range(env.agent_num)]
+    outputs = LLM.generate_batch(prompts, imgs, "consideration_action", list(range(env.agent_num)))
+
+    actions = []
+    for prompt, (text, response) in zip(prompts, outputs):
+        json_data = extract_json(text)
+        if isinstance(json_data, dict):
+            thought = str(json_data.get("thought", ""))
+            action_str = str(json_data.get("action", ""))
+        else:
+            # JSONとして読めなければ応答全体を思考とし, そこから行動名を探す
+            print(f"[Warn] JSON Parse Failed: {text}")
+            thought, action_str = text, text
+        action = env_utils.str_to_action(action_str, params)
+        actions.append(action)
+
+        info["queries"].append(prompt)
+        info["responses"].append(response)
+        info["considerations"].append("You think:" + thought)
+        info["actions"].append([action, action_str])
+
+    # 履歴に思考情報と行動情報を追加
+    reflexion.add_histories("consideration", info["considerations"])
+    actions_str = [env_utils.action_to_str(action, params) for action in actions]
+    reflexion.add_histories("action", actions_str)
+
+    utils.dict_of_lists_extend(pre_info, info)
+    return actions
+
 # エージェント間のメッセージ交換を行う
 def message(env:gym.Env, reflexion:Reflexion, pre_info:dict, params:dict={}):
     info = {
@@ -179,15 +234,20 @@ def message(env:gym.Env, reflexion:Reflexion, pre_info:dict, params:dict={}):
     }
     imgs = env_utils.get_imgs(env, params)
 
+    # 送信元と送信先の組ごとにメッセージを生成し, 送信先の履歴に追加する
+    # 前の組のメッセージを履歴から見ることのない組はプロンプトを先に作ってまとめて生成する
     tree:list[list[int]] = params["message_graph"]
-    for agent_id in range(env.agent_num):
-        agent_name = env_utils.get_agent_name(agent_id, params)
-        for target_id in tree[agent_id]:
-            # メッセージを生成し履歴に追加
+    pairs = [(agent_id, target_id) for agent_id in range(env.agent_num) for target_id in tree[agent_id]]
+    for wave in get_message_waves(pairs, params):
+        prompts = []
+        for agent_id, target_id in wave:
             target_name = env_utils.get_agent_name(target_id, params)
-            prompt = reflexion.get_message_prompt(agent_id, [target_name], params)
-            text, response = LLM.generate(prompt, imgs[agent_id])
+            prompts.append(reflexion.get_message_prompt(agent_id, [target_name], params))
+        outputs = LLM.generate_batch(prompts, [imgs[agent_id] for agent_id, _ in wave], "message", [agent_id for agent_id, _ in wave])
 
+        # メッセージを履歴に追加
+        for (agent_id, target_id), prompt, (text, response) in zip(wave, prompts, outputs):
+            agent_name = env_utils.get_agent_name(agent_id, params)
             if text[:len(agent_name)+1].lower() == f"{agent_name}:".lower():
                 text = text[len(agent_name)+1:]
             reflexion.add_message(target_id, agent_name, text)
@@ -197,6 +257,47 @@ def message(env:gym.Env, reflexion:Reflexion, pre_info:dict, params:dict={}):
             info["messages"].append(text)
     utils.dict_of_lists_extend(pre_info, info)
 
+# メッセージの送信元と送信先の組を, まとめて生成しても逐次実行と結果が変わらない連続した組に分ける
+# 送信元が同じ組の中の送信先になっている場合は, そのメッセージを履歴に追加してからプロンプトを作る
+def get_message_waves(pairs:list[tuple[int, int]], params:dict) -> list[list[tuple[int, int]]]:
+    labels = utils.get_value(params, "history_labels", [])
+    if len(labels) > 0 and "message" not in labels:
+        return [pairs] if len(pairs) > 0 else []
+    waves = []
+    targets = set()
+    for agent_id, target_id in pairs:
+        if len(waves) == 0 or agent_id in targets:
+            waves.append([])
+            targets = set()
+        waves[-1].append((agent_id, target_id))
+        targets.add(target_id)
+    return waves
+
+# 会話グループを, 参加するエージェントが重ならない連続したグループの組(同時に進めても結果が変わらない組)に分ける
+# 重なるグループは, 前のグループのメッセージが履歴に追加されてから会話を始める
+def get_conversation_waves(groups:list[list[int]]) -> list[list[list[int]]]:
+    waves = []
+    agents = set()
+    for group in groups:
+        if len(waves) == 0 or len(agents & set(group)) > 0:
+            waves.append([])
+            agents = set()
+        waves[-1].append(group)
+        agents |= set(group)
+    return waves
+
+# 複数のグループの会話を同時に進め, 発言の順番ごとに全グループ分をまとめて生成する
+# make_prompt(グループ番号, agent_id, is_last)でプロンプトを作り, generate(prompts, agent_ids)の出力をon_response(グループ番号, agent_id, prompt, output)に渡す
+def run_conversation_turns(wave:list[list[int]], params:dict, make_prompt, generate, on_response):
+    count = params["conversation_count"]
+    for i in range(count):
+        for j in range(max(len(group) for group in wave)):
+            turns = [(k, group[j]) for k, group in enumerate(wave) if j < len(group)]
+            prompts = [make_prompt(k, agent_id, i == count - 1 and j == len(wave[k]) - 1) for k, agent_id in turns]
+            outputs = generate(prompts, [agent_id for _, agent_id in turns])
+            for (k, agent_id), prompt, output in zip(turns, prompts, outputs):
+                on_response(k, agent_id, prompt, output)
+
 # エージェント間の対話を行う
 def conversation(env:gym.Env, reflexion:Reflexion, pre_info:dict, params:dict={}):
     info = {
@@ -206,32 +307,38 @@ def conversation(env:gym.Env, reflexion:Reflexion, pre_info:dict, params:dict={}
     }
     imgs = env_utils.get_imgs(env, params)
 
-    # 全てのグループで指定ラウンドの会話を行う
-    for group in params["conversation_pairs"]:
-        messages = []
-        for i in range(params["conversation_count"]):
-            for j, agent_id in enumerate(group):
-                is_last = i == (params["conversation_count"] - 1) and (j == len(group) - 1)
-                agent_name = env_utils.get_agent_name(agent_id, params)
-                targets_id = [target_id for target_id in group if target_id != agent_id]
-                targets_str = [env_utils.get_agent_name(target_id, params) for target_id in targets_id]
-
-                # メッセージを生成
-                prompt = reflexion.get_conversation_prompt(agent_id, targets_str, messages, is_last, params)
-                text, response = LLM.generate(prompt, imgs[agent_id])
-                if text[:len(agent_name)+1].lower() == f"{agent_name}:".lower():
-                    text = text[len(agent_name)+1:]
-
-                messages.append((agent_name, text))
-
-                info["responses"].append(str(response))
-                info["queries"].append(prompt)
-                info["messages"].append(text)
+    # 全てのグループで指定ラウンドの会話を行う(参加エージェントが重ならないグループは同時に進める)
+    for wave in get_conversation_waves(params["conversation_pairs"]):
+        messages = [[] for _ in wave]
+        logs = [{"queries":[], "responses":[], "messages":[]} for _ in wave]
+
+        def make_prompt(k:int, agent_id:int, is_last:bool) -> str:
+            targets_str = [env_utils.get_agent_name(target_id, params) for target_id in wave[k] if target_id != agent_id]
+            return reflexion.get_conversation_prompt(agent_id, targets_str, messages[k], is_last, params)
 
-        # 会話に参加したエージェントの履歴にメッセージを追加
-        for id in group:
-            for name, text in messages:
-                reflexion.add_message(id, name, text)
+        def generate(prompts:list[str], agent_ids:list[int]) -> list[tuple]:
+            return LLM.generate_batch(prompts, [imgs[agent_id] for agent_id in agent_ids], "conversation", agent_ids)
+
+        def on_response(k:int, agent_id:int, prompt:str, output:tuple):
+            text, response = output
+            agent_name = env_utils.get_agent_name(agent_id, params)
+            if text[:len(agent_name)+1].lower() == f"{agent_name}:".lower():
+                text = text[len(agent_name)+1:]
+
+            messages[k].append((agent_name, text))
+
+            logs[k]["responses"].append(str(response))
+            logs[k]["queries"].append(prompt)
+            logs[k]["messages"].append(text)
+
+        run_conversation_turns(wave, params, make_prompt, generate, on_response)
+
+        # 会話に参加したエージェントの履歴にメッセージを追加(グループの順番に行う)
+        for k, group in enumerate(wave):
+            for id in group:
+                for name, text in messages[k]:
+                    reflexion.add_message(id, name, text)
+            utils.dict_of_lists_extend(info, logs[k])
 
     utils.dict_of_lists_extend(pre_info, info)
 
@@ -257,66 +364,77 @@ def structured_conversation(env:gym.Env, reflexion:Reflexion, pre_info:dict, par
         "intents":[]
     }
     imgs = env_utils.get_imgs(env, params)
-    # 会話ペアごとにループ
-    for group in params["conversation_pairs"]:
-        messages = [] # (sender_name, json_string)
-        for i in range(params["conversation_count"]):
-            for j, agent_id in enumerate(group):
-                is_last = (i == params["conversation_count"] - 1) and (j == len(group) - 1)
-                
-                agent_name = env_utils.get_agent_name(agent_id, params)
-                targets_id = [tid for tid in group if tid != agent_id]
-                targets_str = [env_utils.get_agent_name(tid, params) for tid in targets_id]
-
-                # プロンプト取得
-                prompt = env_utils.get_structured_conversation_instr(agent_id, targets_str, messages, is_last, params)
-                
-                # 生成 (JSONを期待)
-                # LLM.generate は (text, score) または (text, info) を返すと想定
-                response_tuple = LLM.generate(prompt, imgs[agent_id])
-                if isinstance(response_tuple, tuple):
-                    raw_text = response_tuple[0]
-                else:
-                    raw_text = response_tuple # 古い実装の場合
-
-                # JSONパース
-                json_data = extract_json(raw_text)
-                
-                if json_data:
-                    # 成功: JSONを整形して文字列化
-                    json_str = json.dumps(json_data, indent=None) # 1行にする
-                    msg_content = json_data.get("message", "")
-                    intent = json_data.get("intent", "UNKNOWN")
-                    
-                    # 履歴用リストに追加
-                    messages.append((agent_name, json_str))
-                    
-                    # ログ保存
-                    info["messages"].append(msg_content)
-                    info["intents"].append(intent)
-                    
-                    # Reflexion(履歴)に追加
-                    # 人間が読むときは "intent: message" の形の方が見やすいかも
-                    display_text = f"[{intent}] {msg_content} (Plan: {json_data.get('action_plan')})"
-                    reflexion.add_message(agent_id, "SELF", display_text)
-                    for tid in targets_id:
-                        reflexion.add_message(tid, agent_name, display_text)
-                        
-                else:
-                    # 失敗: 生テキストをそのまま使うか、エラーとして扱う
-                    # ここではエラーログを出して生テキストを採用（フォールバック）
-                    print(f"[Warn] JSON Parse Failed: {raw_text}")
-                    messages.append((agent_name, raw_text))
-                    reflexion.add_message(agent_id, "SELF", raw_text)
-                    for tid in targets_id:
-                        reflexion.add_message(tid, agent_name, raw_text)
+    # プロンプトは履歴を使わずグループ内の会話だけから作るので, 全てのグループを同時に進める
+    # 履歴への追加は会話の後にグループの順番で行い, グループごとに逐次実行した場合と同じ順番にする
+    wave = params["conversation_pairs"]
+    messages = [[] for _ in wave] # (sender_name, json_string)
+    logs = [{"queries":[], "responses":[], "messages":[], "intents":[]} for _ in wave]
+    additions = [[] for _ in wave] # (agent_id, sender_name, content)
+
+    def make_prompt(k:int, agent_id:int, is_last:bool) -> str:
+        targets_str = [env_utils.get_agent_name(tid, params) for tid in wave[k] if tid != agent_id]
+        return env_utils.get_structured_conversation_instr(agent_id, targets_str, messages[k], is_last, params)
+
+    def generate(prompts:list[str], agent_ids:list[int]) -> list[tuple]:
+        if utils.get_value(params, "is_use_constrained_decoding", False):
+            # スキーマを強制して生成する
+            return [LLM.generate_structured(prompt, imgs[agent_id], "structured_conversation", agent_id) for prompt, agent_id in zip(prompts, agent_ids)]
+        return LLM.generate_batch(prompts, [imgs[agent_id] for agent_id in agent_ids], "structured_conversation", agent_ids)
+
+    def on_response(k:int, agent_id:int, prompt:str, response_tuple):
+        agent_name = env_utils.get_agent_name(agent_id, params)
+        targets_id = [tid for tid in wave[k] if tid != agent_id]
+        if isinstance(response_tuple, tuple):
+            raw_text = response_tuple[0]
+        else:
+            raw_text = response_tuple # 古い実装の場合
 
-                info["queries"].append(prompt)
-                info["responses"].append(raw_text)
+        # JSONパース
+        json_data = extract_json(raw_text)
+
+        if json_data:
+            # 成功: JSONを整形して文字列化
+            json_str = json.dumps(json_data, indent=None) # 1行にする
+            msg_content = json_data.get("message", "")
+            intent = json_data.get("intent", "UNKNOWN")
+
+            # 履歴用リストに追加
+            messages[k].append((agent_name, json_str))
+
+            # ログ保存
+            logs[k]["messages"].append(msg_content)
+            logs[k]["intents"].append(intent)
+
+            # Reflexion(履歴)に追加
+            # 人間が読むときは "intent: message" の形の方が見やすいかも
+            display_text = f"[{intent}] {msg_content} (Plan: {json_data.get('action_plan')})"
+        else:
+            # 失敗: 生テキストをそのまま使うか、エラーとして扱う
+            # ここではエラーログを出して生テキストを採用（フォールバック）
+            print(f"[Warn] JSON Parse Failed: {raw_text}")
+            messages[k].append((agent_name, raw_text))
+            display_text = raw_text
+        additions[k].append((agent_id, "SELF", display_text))
+        for tid in targets_id:
+            additions[k].append((tid, agent_name, display_text))
+
+        logs[k]["queries"].append(prompt)
+        logs[k]["responses"].append(raw_text)
+
+    if len(wave) > 0:
+        run_conversation_turns(wave, params, make_prompt, generate, on_response)
+    for k in range(len(wave)):
+        for agent_id, sender_name, content in additions[k]:
+            reflexion.add_message(agent_id, sender_name, content)
+        utils.dict_of_lists_extend(info, logs[k])
     utils.dict_of_lists_extend(pre_info, info)
 
+# サブゴールをまとめて判定させる場合の, 1つのサブゴールの判定("'Yes', "など)に見込むトークン数
+SUBGOAL_JUDGE_TOKENS = 4
+
 # 各サブゴールを達成したかの判定を行う
-def judge_subgoal_achievement(env:gym.Env, reflexion:Reflexion, pre_info:dict, is_clear:bool, params:dict={}):
+# is_finalはエピソード終了後の判定で, 最後の行動の後には観測が追加されないため判定を使い回さない
+def judge_subgoal_achievement(env:gym.Env, reflexion:Reflexion, pre_info:dict, is_clear:bool, params:dict={}, is_final:bool=False):
     if env.now_step <= 0: return
     info = {
         "queries":[],
@@ -324,25 +442,66 @@ def judge_subgoal_achievement(env:gym.Env, reflexion:Reflexion, pre_info:dict, i
         "achieved":[],
     }
     imgs = env_utils.get_imgs(env, params)
+
+    # 全エージェントの全サブゴールについての判定をまとめて生成する
+    # "subgoal_judge_mode"が"each"ならサブゴールごとに1つ, "all"ならエージェントごとに1つのプロンプトで全サブゴールを判定させる
+    subgoals_list = [reflexion.subgoal_trees[agent_id].get_subgoals() for agent_id in range(env.agent_num)]
+    judge_mode = utils.get_value(params, "subgoal_judge_mode", "each")
+    assert judge_mode in ["each", "all"]
+    if judge_mode == "each":
+        targets = [(agent_id, i) for agent_id in range(env.agent_num) for i in range(len(subgoals_list[agent_id])-1)]
+    else:
+        targets = [(agent_id, 0) for agent_id in range(env.agent_num) if len(subgoals_list[agent_id]) > 1]
+
+    # 観測が前回の判定から変わっていなければ, 同じサブゴールの判定を使い回す
+    is_use_cache = utils.get_value(params, "is_use_subgoal_judge_cache", False) and not is_final
+    keys = {(agent_id, i): reflexion.get_subgoal_judge_key(agent_id, subgoals_list[agent_id][i:]) for agent_id, i in targets}
+    if is_use_cache:
+        missed = [target for target in targets if keys[target] not in reflexion.subgoal_judges]
+    else:
+        missed = targets
+
+    missed_imgs = [imgs[agent_id] for agent_id, _ in missed]
+    missed_ids = [agent_id for agent_id, _ in missed]
+    if judge_mode == "each":
+        prompts = [reflexion.get_subgoal_achieved_prompt(agent_id, subgoals_list[agent_id][i:], params) for agent_id, i in missed]
+        outputs = LLM.generate_batch(prompts, missed_imgs, "subgoal_judge", missed_ids)
+    else:
+        # リストで答えさせるので, 1語で答える判定とは別の種類として停止文字列を使わず, 生成上限をサブゴール数に合わせる
+        prompts = [reflexion.get_all_subgoals_achieved_prompt(agent_id, subgoals_list[agent_id], params) for agent_id, _ in missed]
+        max_count = max([len(subgoals_list[agent_id]) for agent_id in missed_ids], default=0)
+        profile = {"max_new_tokens": SUBGOAL_JUDGE_TOKENS * max_count + 8}
+        outputs = LLM.generate_batch(prompts, missed_imgs, "subgoal_judge_all", missed_ids, profile)
+    for target, prompt, (judge, _) in zip(missed, prompts, outputs):
+        reflexion.subgoal_judges[keys[target]] = judge
+        info["queries"].append(prompt)
+
+    # エージェントごとの全サブゴールの判定結果
+    judges = {}
+    for agent_id, i in targets:
+        judge = reflexion.subgoal_judges[keys[(agent_id, i)]]
+        if judge_mode == "each":
+            judges[(agent_id, i)] = judge
+            continue
+        # Yes/Noのリストとして読めなかったサブゴールは未達成とする
+        judge_list = [str(j) for j in utils.text_to_str_list(judge)]
+        for k in range(len(subgoals_list[agent_id])-1):
+            judges[(agent_id, k)] = judge_list[k] if k < len(judge_list) else "No"
+
     for agent_id in range(env.agent_num):
         # 各サブゴールを達成したかどうかを判定させる
         subgoal_tree = reflexion.subgoal_trees[agent_id]
-        subgoals = subgoal_tree.get_subgoals()
+        subgoals = subgoals_list[agent_id]
         is_achieved = [False] * len(subgoals)
         log_outputs = ["No"] * len(subgoals)
         if is_clear:
             is_achieved[-1] = True
             log_outputs[-1] = "Yes"
 
-        judge_failed = True
-
-        if judge_failed:
-            for i in range(len(subgoals)-1):
-                prompt = reflexion.get_subgoal_achieved_prompt(agent_id, subgoals[i:], params)
-                judge, _ = LLM.generate(prompt, imgs[agent_id])
-                is_achieved[i] = "yes" in judge.lower()
-                log_outputs[i] = judge
-                info["queries"].append(prompt)
+        for i in range(len(subgoals)-1):
+            judge = judges[(agent_id, i)]
+            is_achieved[i] = "yes" in judge.lower()
+            log_outputs[i] = judge
 
         log_achieved = [(subgoals[i], log_outputs[i]) for i in range(len(subgoals))]
         info["achieved"].append(log_achieved)
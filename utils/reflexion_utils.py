@@ -21,12 +21,20 @@ class Reflexion:
         self.env = env
         base, tasks = env_utils.get_explain(env, obs, params)
         self.tasks = tasks
+        self.token_counts: dict[str, int] = {}
+        self.trim_logs: list[dict] = []
+        self.subgoal_judges: dict[tuple, str] = {}
         self.histories.clear()
         self.subgoal_trees.clear()
         for i in range(self.agent_num):
             self.histories.append(History(base, tasks[i], self.memories[i].contents))
             self.subgoal_trees.append(SubgoalTree(tasks[i]))
 
+    # サブゴール達成判定のキャッシュのキー(観測が変わらない間は同じサブゴールの判定を使い回す)
+    def get_subgoal_judge_key(self, agent_id:int, subgoals:list[str]) -> tuple:
+        history = self.histories[agent_id]
+        return (agent_id, tuple(subgoals), history.get_latest("observation"), history.get_latest("relative_observation"))
+
     # 履歴を追加
     def add_histories(self, label:str, contents):
         if not isinstance(contents, list):
@@ -71,12 +79,12 @@ class Reflexion:
         imgs = env_utils.get_imgs(self.env, params)
         # 個別に反省文を出力するかグループで反省会を開くかの分岐を実装する
         if reflexion_mode == "individual":
-            # 各エージェントが反省文を出力
-            for agent_id in range(self.agent_num):
-                prompt = self.get_reflexion_prompt(agent_id, reflexion_type, reason, params)
-                text, _ = LLM.generate(prompt, imgs[agent_id])
+            # 各エージェントが反省文を出力(全エージェント分をまとめて生成)
+            prompts = [self.get_reflexion_prompt(agent_id, reflexion_type, reason, params) for agent_id in range(self.agent_num)]
+            outputs = LLM.generate_batch(prompts, imgs, "reflexion", list(range(self.agent_num)))
+            for agent_id, (text, _) in enumerate(outputs):
                 self.memories[agent_id].add_memory(text)
-                queries.append(prompt)
+            queries.extend(prompts)
         elif reflexion_mode == "group":
             # 全員の行動履歴を準備
             all_history = ""
@@ -93,14 +101,14 @@ class Reflexion:
                     instr = env_utils.get_group_reflexion_instr(agent_id, reflexion_type, reason, params)
                     prompt = f"{all_history}\n\n{instr}"
                     
-                    text, _ = LLM.generate(prompt, imgs[agent_id])
+                    text, _ = LLM.generate(prompt, imgs[agent_id], "reflexion", agent_id)
                     # 履歴に追加
                     name = env_utils.get_agent_name(agent_id, params)
                     chat_history.append( (name, text) )
                     queries.append(prompt)
             summary_instr = env_utils.get_group_reflexion_summary_instr(chat_history, reason, params)
             summary_prompt = summary_instr # 追加で必要な履歴などを結合できる
-            final_strategy, _ = LLM.generate(summary_prompt, imgs[0])
+            final_strategy, _ = LLM.generate(summary_prompt, imgs[0], "reflexion")
             for agent_id in range(self.agent_num):
                 self.memories[agent_id].add_memory(f"Team Strategy: {final_strategy}")
 
@@ -124,7 +132,7 @@ class Reflexion:
 
         for agent_id in range(self.agent_num):
             prompt = self.get_init_subgoal_prompt(agent_id, params)
-            text, _ = LLM.generate_high(prompt, img)
+            text, _ = LLM.generate_high(prompt, img, "init_subgoal", agent_id)
             subgoals = utils.text_to_str_list(text)
             if len(subgoals) >= 1:
                 subgoals = subgoals[:-1]
@@ -152,7 +160,8 @@ class Reflexion:
         return subgoal_lists
 
     # 簡易的に履歴の文字列を取得する
-    def get_history_str(self, agent_id:int, is_reflexion:bool, params:dict) -> str:
+    # "prompt_token_budget"が指定されていれば, 指示文(reserved_tokens)と合わせて上限に収まるように履歴を削る
+    def get_history_str(self, agent_id:int, is_reflexion:bool, params:dict, reserved_tokens:int=0) -> str:
         if is_reflexion:
             length = utils.get_value(params, "reflexion_history_size", -1)
             labels = utils.get_value(params, "reflexion_history_labels", [])
@@ -162,24 +171,42 @@ class Reflexion:
             labels = utils.get_value(params, "history_labels", [])
             labels_len = utils.get_value(params, "history_labels_len", {})
 
-        history = self.histories[agent_id].get_str(length, labels, labels_len)
+        budget = utils.get_value(params, "prompt_token_budget", None)
+        if budget is None:
+            return self.histories[agent_id].get_str(length, labels, labels_len)
+
+        priorities = utils.get_value(params, "history_label_priorities", {})
+        history, trimmed = self.histories[agent_id].get_str_within_budget(budget - reserved_tokens, self.count_tokens, length, labels, labels_len, priorities)
+        if trimmed["dropped_lines"] > 0:
+            self.trim_logs.append({"agent_id": agent_id, "step": getattr(self.env, "now_step", None), **trimmed})
         return history
+
+    # バックエンドのトークナイザでトークン数を数える(同じ行が何度も現れるので結果を保持しておく)
+    def count_tokens(self, text:str) -> int:
+        if text not in self.token_counts:
+            self.token_counts[text] = LLM.count_tokens(text)
+        return self.token_counts[text]
     
     # 履歴と指示を合わせたプロンプトを返す
     def get_prompt(self, agent_id:int, instr:str, params:dict) -> str:
-        history = self.get_history_str(agent_id, False, params)
+        history = self.get_history_str(agent_id, False, params, self.get_reserved_tokens(instr, params))
         prompt = f"{history}\n\n{instr}"
         return prompt
 
+    # 履歴の後ろに続ける指示文の分のトークン数
+    def get_reserved_tokens(self, instr:str, params:dict) -> int:
+        if utils.get_value(params, "prompt_token_budget", None) is None: return 0
+        return LLM.count_tokens(instr) + 2
+
     # Reflexionを行う時のプロンプトを返す
     def get_reflexion_prompt(self, agent_id:int, reflexion_type:str, reason:str, params) -> str:
-        history = self.get_history_str(agent_id, True, params)
         if reflexion_type == "subgoal":
             instr = env_utils.get_subgoal_reflexion_instr(reason, agent_id, self.subgoal_trees[agent_id], params)
         elif reflexion_type == "general":
             instr = env_utils.get_general_reflexion_instr(reason, agent_id, params)
         else:
             instr = ""
+        history = self.get_history_str(agent_id, True, params, self.get_reserved_tokens(instr, params))
         prompt = f"{history}\n\n{instr}"
         return prompt
 
@@ -209,6 +236,14 @@ class Reflexion:
         prompt = self.get_prompt(agent_id, instr, params)
         return prompt
     
+    # 思考と行動をまとめて生成する際のプロンプトを返す
+    def get_consideration_action_prompt(self, agent_id:int, params:dict) -> str:
+        subgoal_tree = self.subgoal_trees[agent_id]
+        achieved, not_achieved = subgoal_tree.get_achieved_not_achieved()
+        instr = env_utils.get_consideration_action_instr(agent_id, achieved, not_achieved, params)
+        prompt = self.get_prompt(agent_id, instr, params)
+        return prompt
+
     # サブゴールを生成する際のプロンプトを返す
     def get_subgoal_prompt(self, agent_id:int, achieved:list[str], not_achieved:list[str], params:dict) -> str:
         instr = env_utils.get_subgoal_instr(agent_id, achieved, not_achieved, params)
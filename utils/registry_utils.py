@@ -0,0 +1,48 @@
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import utils.utils as utils
+
+# 読み込んだモデルの重みをプロセス内で共有するための処理
+# main.pyで複数のconfigを続けて実行する場合などに, 同じ設定で読み込むモデルは読み込み直さずに使い回す
+
+# 処理にかかった時間を表示する
+@contextmanager
+def load_timer(label:str):
+    start = time.perf_counter()
+    yield
+    print(f"[info] {label}: {time.perf_counter() - start:.1f}s")
+
+class ModelRegistry:
+    __models: OrderedDict[tuple, object] = OrderedDict()
+    __max_size: int = 2
+
+    # 保持するモデル数の上限("llm_registry_size")を設定する
+    @classmethod
+    def configure(cls, params:dict):
+        cls.__max_size = utils.get_value(params, "llm_registry_size", 2)
+
+    # keyに対応するモデルを返す(なければload()で読み込み, warmup(model)で1度だけ慣らし運転をする)
+    # keyにはモデル名と読み込み方に関わる設定(量子化など)を含める
+    @classmethod
+    def get(cls, key:tuple, load, warmup = None):
+        if key in cls.__models:
+            cls.__models.move_to_end(key)
+            print(f"[info] reuse loaded model {key[0]}")
+            return cls.__models[key]
+
+        with load_timer(f"load weights of {key[0]}"):
+            model = load()
+        if warmup is not None:
+            with load_timer(f"warm up {key[0]}"):
+                warmup(model)
+
+        # 上限を超えたら最も長く使われていないモデルを手放す(使用中のインスタンスが持つ分は解放されない)
+        cls.__models[key] = model
+        while len(cls.__models) > max(cls.__max_size, 1):
+            cls.__models.popitem(last=False)
+        return model
+
+    @classmethod
+    def clear(cls):
+        cls.__models.clear()
@@ -0,0 +1,105 @@
+import os
+import json
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+import utils.utils as utils
+from utils.cache_utils import get_text_hash
+
+# LLMの潜在表現(最終層の隠れ状態)を保持するための処理
+# メモリ上では件数に上限のあるLRUで保持し, 指定があればディスク上のmemmapにも保存して実行をまたいで再利用する
+
+# ディスク上の潜在表現の保存先(モデルごとにベクトルを並べたmemmapとプロンプトのハッシュ値から行番号への索引を持つ)
+class RepresentationFile:
+    def __init__(self, path:str):
+        self.path = path
+        self.index_path = os.path.join(path, "index.json")
+        self.data_path = os.path.join(path, "vectors.f32")
+        os.makedirs(path, exist_ok=True)
+
+        self.rows: dict[str, int] = {}
+        self.dim = None
+        self.capacity = 0
+        self.vectors = None
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self.rows = index["rows"]
+            self.dim = index["dim"]
+            self.open(os.path.getsize(self.data_path) // (4 * self.dim))
+
+    def open(self, capacity:int):
+        self.capacity = capacity
+        self.vectors = np.memmap(self.data_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    # 容量が足りなければファイルを倍の大きさに広げる
+    def reserve(self, count:int):
+        if count <= self.capacity: return
+        capacity = max(count, self.capacity * 2, 64)
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+        with open(self.data_path, "ab") as f:
+            f.truncate(capacity * self.dim * 4)
+        self.open(capacity)
+
+    def get(self, key:str):
+        if key not in self.rows: return None
+        return np.array(self.vectors[self.rows[key]])
+
+    def set_batch(self, items:list[tuple[str, np.ndarray]]):
+        items = [(key, vector) for key, vector in items if key not in self.rows]
+        if len(items) == 0: return
+        if self.dim is None:
+            self.dim = len(items[0][1])
+        self.reserve(len(self.rows) + len(items))
+        for key, vector in items:
+            row = len(self.rows)
+            self.vectors[row] = vector
+            self.rows[key] = row
+        self.vectors.flush()
+        # 書き込み途中で中断しても索引が壊れないよう, 一時ファイルに書いてから置き換える(ベクトルは先に書き終えている)
+        fd, temp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({"dim": self.dim, "rows": self.rows}, f)
+            os.replace(temp_path, self.index_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+# メモリ上のLRUとディスク上のmemmapを組み合わせた潜在表現のキャッシュ
+class RepresentationStore:
+    def __init__(self, model_name:str, params:dict={}):
+        self.max_size = utils.get_value(params, "representation_cache_size", 4096)
+        self.memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.file = None
+        cache_dir = utils.get_value(params, "representation_cache_dir", None)
+        if cache_dir is not None:
+            self.file = RepresentationFile(os.path.join(cache_dir, get_text_hash(model_name)[:16]))
+
+    def get(self, prompt:str):
+        key = get_text_hash(prompt)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.file is None: return None
+        vector = self.file.get(key)
+        if vector is not None:
+            self.remember(key, vector)
+        return vector
+
+    def set_batch(self, prompts:list[str], vectors:list[np.ndarray]):
+        keys = [get_text_hash(prompt) for prompt in prompts]
+        for key, vector in zip(keys, vectors):
+            self.remember(key, vector)
+        if self.file is not None:
+            self.file.set_batch(list(zip(keys, vectors)))
+
+    # 上限を超えたら最も長く参照されていないものから捨てる
+    def remember(self, key:str, vector:np.ndarray):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
@@ -0,0 +1,112 @@
+import threading
+import concurrent.futures
+import utils.utils as utils
+
+# 呼び出しの種類(phase)ごとに使うモデルを切り替えるための処理
+# 行動選択は軽いローカルモデル, 反省や初期サブゴールは大きいモデルといった割り当てをconfigの"llm_routes"で指定する
+# 例: {"action": "meta-llama/Meta-Llama-3.1-8B-Instruct", "reflexion": {"model": "gpt-4o", "fallback": "gpt-4o-mini", "timeout": 30}}
+# 指定のない種類は"default"の割り当て, それもなければ通常のモデル(llm_model, llm_high_model)を使う
+
+PRIMARY = "primary"
+FALLBACK = "fallback"
+
+# 1つの呼び出しの種類に対するモデルの割り当て
+class Route:
+    def __init__(self, llm, fallback = None, timeout:float = None):
+        self.llm = llm
+        self.fallback = fallback
+        self.timeout = timeout
+
+# 1回の呼び出しの結果を確定させるための目印
+# 時間切れで見捨てた呼び出しが後から終わっても, その結果はキャッシュや使用量の記録に残さない
+class Ticket:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = None
+
+    # 結果を確定する(既に見捨てられていればFalse)
+    def commit(self) -> bool:
+        with self.lock:
+            if self.state is None:
+                self.state = "committed"
+            return self.state == "committed"
+
+    # 呼び出しを見捨てる(既に結果が確定していればFalse)
+    def abandon(self) -> bool:
+        with self.lock:
+            if self.state is None:
+                self.state = "abandoned"
+            return self.state == "abandoned"
+
+class Router:
+    def __init__(self):
+        self.routes: dict[str, Route] = {}
+        # 時間切れになった呼び出しは止められないので, 終わるまではそのモデルを使わずに予備のモデルに回す
+        self.executors: dict[str, concurrent.futures.ThreadPoolExecutor] = {}
+        self.pendings: dict[str, concurrent.futures.Future] = {}
+
+    # get_llmはモデル名からLLMを返す関数(同じモデル名は1度だけ読み込む)
+    def load(self, params:dict, get_llm):
+        llms = {}
+        def get(model_name:str):
+            if model_name not in llms:
+                llms[model_name] = get_llm(model_name)
+            return llms[model_name]
+
+        routes = {}
+        for phase, route in utils.get_value(params, "llm_routes", {}).items():
+            if isinstance(route, str):
+                route = {"model": route}
+            fallback = get(route["fallback"]) if "fallback" in route else None
+            routes[phase] = Route(get(route["model"]), fallback, utils.get_value(route, "timeout", None))
+        self.routes = routes
+
+    def get_route(self, phase:str) -> Route:
+        return utils.get_value(self.routes, phase, utils.get_value(self.routes, "default", None))
+
+    # 見捨てた呼び出しがまだ続いているか
+    def is_busy(self, llm) -> bool:
+        pending = utils.get_value(self.pendings, llm.model_name, None)
+        return pending is not None and not pending.done()
+
+    # 見捨てた呼び出しが続いているモデル(インスタンスは割り当てと通常のモデルで共有している)は, 終わるまで待ってから使う
+    def wait(self, llm):
+        pending = self.pendings.pop(llm.model_name, None)
+        if pending is None: return
+        if not pending.done():
+            print(f"[Warn] waiting for the timed-out call on {llm.model_name} to finish")
+        concurrent.futures.wait([pending])
+
+    # 割り当てられたモデルでcall(llm, role, ticket)を実行し, 時間切れやエラーの場合は予備のモデルで実行し直す
+    def call(self, phase:str, default_llm, call):
+        route = self.get_route(phase)
+        if route is None:
+            self.wait(default_llm)
+            return call(default_llm, "", Ticket())
+        if route.fallback is None:
+            self.wait(route.llm)
+            return call(route.llm, PRIMARY, Ticket())
+
+        model_name = route.llm.model_name
+        if self.is_busy(route.llm):
+            print(f"[Warn] {model_name} is still busy, {route.fallback.model_name} answers {phase}")
+            self.wait(route.fallback)
+            return call(route.fallback, FALLBACK, Ticket())
+        self.wait(route.llm)
+
+        if model_name not in self.executors:
+            self.executors[model_name] = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        ticket = Ticket()
+        future = self.executors[model_name].submit(call, route.llm, PRIMARY, ticket)
+        try:
+            return future.result(timeout=route.timeout)
+        except concurrent.futures.TimeoutError:
+            # 結果の確定と時間切れが重なった場合は, 確定した結果を使う
+            if not ticket.abandon():
+                return future.result()
+            self.pendings[model_name] = future
+            print(f"[Warn] {model_name} timed out after {route.timeout}s, {route.fallback.model_name} answers {phase}")
+        except Exception as e:
+            print(f"[Warn] {model_name} failed ({type(e).__name__}: {e}), {route.fallback.model_name} answers {phase}")
+        self.wait(route.fallback)
+        return call(route.fallback, FALLBACK, Ticket())
@@ -0,0 +1,103 @@
+import csv
+import time
+import threading
+
+# LLMの呼び出しごとのトークン数と所要時間を記録するための処理
+# どの呼び出しの種類(phase)に時間やトークンがかかっているかをTrial単位で集計し, CSVにも出力できるようにする
+
+USAGE_FIELDS = [
+    "trial", "step", "phase", "agent_id", "backend", "model",
+    "prompt_tokens", "generated_tokens", "prefill_time", "decode_time", "latency", "cache_hit", "route",
+]
+
+# model.generateのstreamerとして渡し, 最初のトークンが出るまで(prefill)の時間を測る
+# generateは最初にプロンプトを, その後は生成したトークンを1つずつputする
+class TimingStreamer:
+    def __init__(self, timing:dict):
+        self.timing = timing
+        self.start = None
+        self.is_first_token = True
+
+    def put(self, value):
+        now = time.perf_counter()
+        if self.start is None:
+            self.start = now
+        elif self.is_first_token:
+            self.timing["prefill_time"] = self.timing.get("prefill_time", 0.0) + now - self.start
+            self.is_first_token = False
+
+    def end(self):
+        pass
+
+# 呼び出しごとの記録を保持するクラス
+class UsageRecorder:
+    def __init__(self):
+        self.records: list[dict] = []
+        self.trial = None
+        self.step = None
+        # ルーティングによる呼び出しは別スレッドで行われることがあるので, スレッドごとに保持する
+        self.local = threading.local()
+
+    def set_context(self, trial:int = None, step:int = None):
+        self.trial = trial
+        self.step = step
+
+    # 割り当てられたモデル("primary")と予備のモデル("fallback")のどちらが応答したか
+    def set_route(self, route:str):
+        self.local.route = route
+
+    # まとめて呼び出した入力それぞれについて記録する
+    # 実際に生成した入力には所要時間を等分して割り当て, キャッシュから取得した入力は0とする
+    def record_batch(self, llm, phase:str, agent_ids:list, prompts:list[str], outputs:list[tuple], missed:list[int], elapsed:float):
+        missed = set(missed)
+        latency = elapsed / len(missed) if len(missed) > 0 else 0.0
+        prefill_time = llm.timing.get("prefill_time")
+        prefill_time = prefill_time / len(missed) if prefill_time is not None and len(missed) > 0 else None
+        for i, (prompt, (text, response)) in enumerate(zip(prompts, outputs)):
+            is_hit = i not in missed
+            # APIが使用トークン数を返していればそれを使う
+            if isinstance(response, dict) and "input_token" in response:
+                prompt_tokens, generated_tokens = response["input_token"], response["output_token"]
+            else:
+                prompt_tokens, generated_tokens = llm._count_tokens(prompt), llm._count_tokens(str(text))
+            self.records.append({
+                "trial": self.trial,
+                "step": self.step,
+                "phase": phase,
+                "agent_id": agent_ids[i],
+                "backend": llm.backend_class.__name__,
+                "model": llm.model_name,
+                "prompt_tokens": prompt_tokens,
+                "generated_tokens": generated_tokens,
+                "prefill_time": 0.0 if is_hit or prefill_time is None else prefill_time,
+                "decode_time": 0.0 if is_hit or prefill_time is None else latency - prefill_time,
+                "latency": 0.0 if is_hit else latency,
+                "cache_hit": is_hit,
+                "route": getattr(self.local, "route", ""),
+            })
+
+    # 指定したTrialの記録を呼び出しの種類ごとに集計する
+    def summarize(self, trial:int = None) -> dict:
+        summary = {}
+        for record in self.records:
+            if trial is not None and record["trial"] != trial: continue
+            phase = summary.setdefault(record["phase"], {
+                "calls": 0, "cache_hits": 0, "fallbacks": 0, "prompt_tokens": 0, "generated_tokens": 0,
+                "prefill_time": 0.0, "decode_time": 0.0, "latency": 0.0,
+            })
+            phase["calls"] += 1
+            phase["cache_hits"] += int(record["cache_hit"])
+            phase["fallbacks"] += int(record["route"] == "fallback")
+            for key in ["prompt_tokens", "generated_tokens", "prefill_time", "decode_time", "latency"]:
+                phase[key] += record[key]
+        return summary
+
+    def to_csv(self, path:str, trial:int = None):
+        records = [record for record in self.records if trial is None or record["trial"] == trial]
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=USAGE_FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+
+    def clear(self):
+        self.records = []
@@ -1,4 +1,6 @@
 import base64
+import hashlib
+from collections import OrderedDict
 from io import BytesIO
 from PIL import Image
 import numpy as np
@@ -30,15 +32,31 @@ def get_value(dict:dict, key:str, default):
         return dict[key]
     return default
 
+# 画像をエンコードした結果を画素値のハッシュ値をキーとして保持する
+# 同じステップ内では各エージェント・各呼び出しで同じ画像を使うので, 2回目以降はエンコードを省ける
+IMAGE_CACHE_SIZE = 64
+image_base64_cache: OrderedDict[str, str] = OrderedDict()
+
 def np_image_to_base64(img, format="jpeg") -> str:
-    pil_image = Image.fromarray(img)
+    array = np.ascontiguousarray(img)
+    hasher = hashlib.sha1(f"{array.shape}{array.dtype.str}{format}".encode())
+    hasher.update(array.tobytes())
+    key = hasher.hexdigest()
+    if key in image_base64_cache:
+        image_base64_cache.move_to_end(key)
+        return image_base64_cache[key]
+
+    pil_image = Image.fromarray(array)
     width, height = pil_image.size
     pil_image = pil_image.resize((width // 2, height // 2))
-    pil_image.save("tmp.jpg")
 
     buffer = BytesIO()
     pil_image.save(buffer, format)
     img_str = base64.b64encode(buffer.getvalue()).decode("ascii")
+
+    image_base64_cache[key] = img_str
+    if len(image_base64_cache) > IMAGE_CACHE_SIZE:
+        image_base64_cache.popitem(last=False)
     return img_str
 
 def initial_to_upper(text:str) -> str:
@@ -0,0 +1,66 @@
+import queue
+import threading
+
+# 描画結果やログのファイル出力など, LLMの応答を待たずに進められる処理を別スレッドで実行するための処理
+# 渡した処理は渡した順に1つずつ実行し, flush()で全ての処理が終わるまで待つ(Trialの終わりなどで呼ぶ)
+
+STOP = object()
+
+class BackgroundWorker:
+    def __init__(self, is_enabled:bool = True):
+        self.is_enabled = is_enabled
+        self.lock = threading.Lock()
+        self.pendings: dict = {}
+        self.queue = queue.Queue()
+        self.errors: list[Exception] = []
+        self.thread = None
+        if is_enabled:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    # func(*args)を実行する(無効な場合はその場で実行する)
+    # keyが同じでまだ実行していない処理があれば, その処理を置き換える(同じファイルへの出力が溜まった場合は最新のものだけを書く)
+    # 渡した引数は後で別スレッドから読まれるので, 呼び出し側で変更するものは複製してから渡すこと
+    def submit(self, func, *args, key = None):
+        if not self.is_enabled:
+            func(*args)
+            return
+        with self.lock:
+            if key is not None and key in self.pendings:
+                self.pendings[key] = (func, args)
+                return
+            if key is None:
+                key = object()
+            self.pendings[key] = (func, args)
+        self.queue.put(key)
+
+    def run(self):
+        while True:
+            key = self.queue.get()
+            if key is STOP:
+                self.queue.task_done()
+                break
+            with self.lock:
+                func, args = self.pendings.pop(key)
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"[Warn] background task {getattr(func, '__name__', func)} failed ({type(e).__name__}: {e})")
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    # 渡した処理が全て終わるまで待ち, 失敗した処理があればその例外を送出する
+    def flush(self):
+        if self.is_enabled:
+            self.queue.join()
+        if len(self.errors) > 0:
+            error = self.errors[0]
+            self.errors = []
+            raise error
+
+    def close(self):
+        self.flush()
+        if self.is_enabled:
+            self.queue.put(STOP)
+            self.thread.join()